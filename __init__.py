@@ -1,2 +1,2 @@
-from components import cameras,sensors,tools,mirrors,loops,ui
+from components import cameras,sensors,tools,mirrors,loops,ui,pipeline
 import config
@@ -18,9 +18,9 @@ if len(sys.argv)<4:
 N = int(sys.argv[1])
 
 if sys.argv[2].lower()=='real':
-    cam = cameras.PylonCamera()
+    cam = cameras.get_camera('pylon')
 elif sys.argv[2].lower()=='simulated':
-    cam = cameras.SimulatedCamera()
+    cam = cameras.get_camera('simulated')
 
 output_filename = sys.argv[3]
 
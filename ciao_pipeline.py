@@ -0,0 +1,44 @@
+import ciao
+import numpy as np
+import sys
+import time
+from PyQt5.QtWidgets import QApplication
+
+# Run the loop as a headless pipeline, printing latencies every second,
+# or, with the argument 'ui', with the UI showing the pipeline's snapshots.
+# A camera name among the arguments (e.g. 'replay') overrides
+# ccfg.camera_backend.
+
+# the camera is chosen by ccfg.camera_backend; with
+# ccfg.camera_use_acquisition, frames are grabbed on a separate thread,
+# overlapping exposure with processing
+names = [arg.lower() for arg in sys.argv[1:] if arg.lower() in ciao.cameras.camera_classes]
+if names:
+    cam = ciao.cameras.get_camera(names[0])
+else:
+    cam = ciao.cameras.get_camera()
+sensor = ciao.sensors.Sensor(cam)
+
+mirror = ciao.mirrors.Mirror()
+# a SyntheticCamera renders spots from the mirror's command
+if hasattr(cam,'set_mirror'):
+    cam.set_mirror(mirror)
+
+app = QApplication(sys.argv)
+# the loop provides the control matrix and the control law; its Qt
+# threads are not started
+loop = ciao.loops.Loop(sensor,mirror)
+pipeline = ciao.pipeline.Pipeline(loop)
+pipeline.start()
+
+if 'ui' in sys.argv:
+    ui = ciao.ui.UI(loop,pipeline)
+    sys.exit(app.exec_())
+else:
+    loop.set_closed(True)
+    try:
+        while True:
+            time.sleep(1.0)
+            pipeline.print_latency()
+    except KeyboardInterrupt:
+        pipeline.stop()
@@ -0,0 +1,194 @@
+"""Acquisition of camera frames on a dedicated thread.
+
+Sensor.sense gets its image from the camera synchronously, so the
+camera's exposure and readout are serialized with centroiding and
+reconstruction. Acquisition wraps a camera and grabs frames continuously
+on its own thread, so that the next exposure overlaps the processing of
+the current frame. It can be used wherever a camera is: its get_image
+returns the oldest frame not yet consumed, and other attributes are
+looked up on the wrapped camera.
+
+Frames are grabbed into a fixed pool of buffers owned by the
+acquisition. Up to queue_size frames wait for the consumer; when the
+queue is full, the oldest waiting frame is dropped and its buffer
+reused, so the consumer never falls further behind than queue_size
+frames. The last n_held frames returned to the consumer are not reused
+until it has taken n_held more, since the Sensor keeps a reference to
+the images of its last two frames.
+
+The camera is started and stopped with the acquisition, and frames are
+grabbed with its grab_into (see camera_interface.py). Acquisition itself
+implements the same interface, so it can stand in for its camera; the
+frames it drops are counted in their metadata.
+
+"""
+
+import numpy as np
+import threading
+from collections import deque
+from ciao import config as ccfg
+from camera_interface import FrameMetadata
+
+class GrabbedFrame:
+
+    def __init__(self):
+        """A buffer for one frame, with its FrameMetadata."""
+        self.image = None
+        self.metadata = FrameMetadata()
+
+
+class Acquisition:
+
+    def __init__(self,camera,queue_size=None,n_held=3):
+        """Wrap camera for continuous acquisition; call start to begin.
+
+        Args:
+
+          camera: the camera to grab from
+
+          queue_size (int): the number of frames that may wait for the
+            consumer; defaults to ccfg.camera_queue_size
+
+          n_held (int): the number of frames, most recently returned to
+            the consumer, whose buffers are not reused
+        """
+        if queue_size is None:
+            queue_size = ccfg.camera_queue_size
+        self.camera = camera
+        self.queue_size = queue_size
+        self.n_held = n_held
+
+        # one more buffer than can be queued and held, for grabbing into
+        self.free = deque([GrabbedFrame() for k in range(queue_size+n_held+1)])
+        self.queue = deque()
+        self.held = deque()
+        self.condition = threading.Condition()
+
+        self.n_grabbed = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+        self.error = None
+        self.metadata = FrameMetadata()
+        self.running = False
+        self.thread = None
+
+    def __getattr__(self,name):
+        # only called for attributes not found on the acquisition itself
+        return getattr(self.__dict__['camera'],name)
+
+    def start(self,n_buffers=None):
+        """Start the camera, with n_buffers driver buffers (by default
+        ccfg.camera_grab_buffers), and the acquisition thread."""
+        if self.running:
+            return
+        if n_buffers is None:
+            n_buffers = ccfg.camera_grab_buffers
+        self.camera.start(n_buffers)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.camera.stop()
+
+    def set_roi(self,x,y,width,height):
+        """Set the camera's region of interest (see PylonCamera.set_roi),
+        stopping acquisition while it changes, and discard the frames
+        waiting in the queue, which were read out with the old region."""
+        running = self.running
+        if running:
+            self.stop()
+        roi = self.camera.set_roi(x,y,width,height)
+        with self.condition:
+            while self.queue:
+                self.free.append(self.queue.popleft())
+        if running:
+            self.start()
+        return roi
+
+    def grab(self,frame):
+        frame.image,frame.metadata = self.camera.grab_into(frame.image)
+
+    def run(self):
+        # After a failed grab, the next is tried after retry_delay, which
+        # doubles, up to 1 s, while grabs keep failing (e.g. the camera
+        # is unplugged); an error is printed only when it differs from
+        # the last one. Unlike the waits for frames (see get_frame), this
+        # one is timed: it is a delay, so the polling's up to 50 ms of
+        # extra latency doesn't matter, and stop notifies to end it.
+        retry_delay = 0.0
+        last_error = None
+        while self.running:
+            with self.condition:
+                if len(self.queue)>=self.queue_size:
+                    frame = self.queue.popleft()
+                    self.n_dropped+=1
+                else:
+                    frame = self.free.popleft()
+            try:
+                self.grab(frame)
+            except Exception as e:
+                if repr(e)!=last_error:
+                    print e
+                    last_error = repr(e)
+                retry_delay = min(max(2*retry_delay,0.01),1.0)
+                with self.condition:
+                    self.free.append(frame)
+                    self.n_errors+=1
+                    self.error = e
+                    self.condition.notify()
+                    # stop notifies, ending the wait early
+                    if self.running:
+                        self.condition.wait(retry_delay)
+                continue
+            retry_delay = 0.0
+            last_error = None
+            with self.condition:
+                self.queue.append(frame)
+                self.n_grabbed+=1
+                self.condition.notify()
+
+    def get_frame(self):
+        """Return the oldest GrabbedFrame not yet consumed, waiting for
+        one to arrive. If the camera fails (e.g. times out) before a frame
+        arrives, its exception is raised."""
+        with self.condition:
+            # untimed, as in pipeline.Handoff.take; the acquisition
+            # thread notifies on errors and when stopped
+            while not self.queue and self.error is None and self.running:
+                self.condition.wait()
+            if not self.queue:
+                error = self.error
+                self.error = None
+                if error is None:
+                    error = RuntimeError('Acquisition is not running.')
+                raise error
+            self.error = None
+            frame = self.queue.popleft()
+            self.held.append(frame)
+            if len(self.held)>self.n_held:
+                self.free.append(self.held.popleft())
+            # count the frames dropped from the queue as well as those
+            # the camera dropped
+            frame.metadata.dropped+=self.n_dropped
+        self.metadata = frame.metadata
+        return frame
+
+    def get_image(self):
+        return self.get_frame().image
+
+    def grab_into(self,buffer=None):
+        """Copy the next frame into buffer (allocated if None, or if its
+        shape or dtype differs), and return (buffer,metadata)."""
+        frame = self.get_frame()
+        if buffer is None or buffer.shape!=frame.image.shape or buffer.dtype!=frame.image.dtype:
+            buffer = np.empty(frame.image.shape,dtype=frame.image.dtype)
+        np.copyto(buffer,frame.image)
+        return buffer,frame.metadata
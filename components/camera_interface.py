@@ -0,0 +1,126 @@
+"""The interface shared by all cameras.
+
+A camera provides:
+
+  start, stop:    begin and end continuous grabbing; cameras which
+                  produce frames on demand (the simulated ones) need not
+                  do anything
+  grab_into:      copy (or render) the next frame into a given buffer,
+                  and return the buffer and the frame's FrameMetadata
+  get_image:      grab the next frame into one of the camera's own
+                  buffers, which are reused in rotation
+  get_roi,
+  set_roi:        the region of the sensor read out, as
+                  (x,y,width,height) in pixels of the full sensor
+  get_exposure,
+  set_exposure:   the exposure time, in microseconds
+  get_search_boxes: the search boxes and lenslet mask the camera's images
+                  were made with, for cameras which make their own (the
+                  SyntheticCamera), or None
+
+Camera implements everything but grab_into for cameras which read out
+a region by cropping full frames; see cameras.py and simulator.py for the
+implementations, and cameras.get_camera for selecting one by name.
+
+"""
+
+import numpy as np
+import time
+
+class FrameMetadata:
+
+    def __init__(self,frame_id=-1,timestamp=0.0,dropped=0,camera_timestamp=None):
+        """A description of a grabbed frame.
+
+        Args:
+
+          frame_id (int): the frame's number, counting from the first
+            frame grabbed, including any dropped frames
+
+          timestamp (float): the time the frame was grabbed, from
+            time.time()
+
+          dropped (int): the number of frames dropped so far, i.e. grabbed
+            by the camera but never returned
+
+          camera_timestamp: the camera's own timestamp, in camera ticks,
+            if it provides one
+        """
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.dropped = dropped
+        self.camera_timestamp = camera_timestamp
+
+
+class Camera(object):
+
+    def __init__(self,width,height,exposure=None):
+        """Base class for cameras with a sensor of width x height pixels.
+        Subclasses implement grab_into."""
+        self.width = width
+        self.height = height
+        self.roi = (0,0,width,height)
+        self.exposure = exposure
+        self.n_grabbed = 0
+        self.n_dropped = 0
+        self.metadata = FrameMetadata()
+        # get_image grabs into these in turn, so an image stays valid
+        # until the next call but one (the Sensor keeps the images of
+        # its last two frames)
+        self.buffers = [None,None]
+        self.buffer_index = 0
+
+    def start(self,n_buffers=None):
+        pass
+
+    def stop(self):
+        pass
+
+    def grab_into(self,buffer=None):
+        """Copy the next frame into buffer (allocated if None, or if its
+        shape or dtype differs from the frame's), and return
+        (buffer,metadata)."""
+        raise NotImplementedError
+
+    def get_image(self):
+        """Grab the next frame into one of the camera's buffers and return
+        it; its metadata is left in self.metadata."""
+        out,self.metadata = self.grab_into(self.buffers[self.buffer_index])
+        self.buffers[self.buffer_index] = out
+        self.buffer_index = (self.buffer_index+1)%len(self.buffers)
+        return out
+
+    def make_metadata(self,camera_timestamp=None):
+        """Return the metadata of a frame grabbed now, and count it."""
+        metadata = FrameMetadata(self.n_grabbed+self.n_dropped,time.time(),self.n_dropped,camera_timestamp)
+        self.n_grabbed+=1
+        return metadata
+
+    def get_roi(self):
+        return self.roi
+
+    def set_roi(self,x,y,width,height):
+        """Read out only the region (x,y,width,height), clipped to the
+        sensor, and return the region."""
+        x = max(x,0)
+        y = max(y,0)
+        width = min(width,self.width-x)
+        height = min(height,self.height-y)
+        self.roi = (x,y,width,height)
+        return self.roi
+
+    def crop(self,image):
+        """Return the region of interest of a full frame, as a view."""
+        x,y,width,height = self.roi
+        return image[y:y+height,x:x+width]
+
+    def get_exposure(self):
+        return self.exposure
+
+    def set_exposure(self,exposure):
+        self.exposure = exposure
+
+    def get_search_boxes(self):
+        """Return (search_boxes,lenslet_mask) if the camera defines its
+        own lenslet layout, else None."""
+        return None
@@ -1,14 +1,36 @@
+"""Cameras, and their selection by name.
+
+Every camera implements the interface in camera_interface.py. get_camera
+creates the camera registered under a name given in the config
+(ccfg.camera_backend), so scripts and benchmarks can switch between the
+hardware and stand-ins without changes:
+
+  'pylon':     a Basler camera, through pypylon
+  'simulated': recorded frames from ccfg.simulated_camera_image_directory
+  'synthetic': spots rendered from the mirror's command (see simulator.py)
+  'replay':    recorded frames held in memory, replayed at any frame rate
+
+Other cameras can be added with register_camera.
+
+"""
+
 import numpy as np
 import glob
 from ciao import config as ccfg
 import os,sys
+import hashlib
+import time
+from camera_interface import Camera,FrameMetadata
+from opacity import OpacityModel
+from simulator import SyntheticCamera
+from acquisition import Acquisition
 try:
     from pypylon import pylon
 except Exception as e:
     print e
 
 
-class PylonCamera:
+class PylonCamera(Camera):
 
     def __init__(self,timeout=500):
         self.camera = pylon.InstantCamera(
@@ -18,58 +40,329 @@ class PylonCamera:
 
         # enable all chunks
         self.camera.ChunkModeActive = True
-        #self.camera.PixelFormat = "Mono12"
-        
+        if ccfg.camera_pixel_format is not None:
+            self.camera.PixelFormat = ccfg.camera_pixel_format
+
         for cf in self.camera.ChunkSelector.Symbolics:
             self.camera.ChunkSelector = cf
             self.camera.ChunkEnable = True
 
+        Camera.__init__(self,self.camera.WidthMax.Value,self.camera.HeightMax.Value)
         self.timeout = timeout
+        self.last_block_id = None
+        if ccfg.camera_exposure_us is not None:
+            self.set_exposure(ccfg.camera_exposure_us)
 
-    def get_image(self):
-        return self.camera.GrabOne(self.timeout).Array.astype(np.int16)
+    def get_roi(self):
+        """Return the region read out, as (x,y,width,height) in pixels
+        of the full sensor."""
+        c = self.camera
+        return c.OffsetX.Value,c.OffsetY.Value,c.Width.Value,c.Height.Value
+
+    def set_roi(self,x,y,width,height):
+        """Read out only the region (x,y,width,height) of the sensor,
+        grown as needed to meet the camera's increments for offsets and
+        sizes, and return the region actually set (see get_roi). If the
+        camera is grabbing, grabbing is stopped while the region is
+        changed."""
+        c = self.camera
+        x1 = x-x%c.OffsetX.Inc
+        y1 = y-y%c.OffsetY.Inc
+        width = width+(x-x1)
+        height = height+(y-y1)
+        width = min(int(np.ceil(width/float(c.Width.Inc)))*c.Width.Inc,c.WidthMax.Value-x1)
+        height = min(int(np.ceil(height/float(c.Height.Inc)))*c.Height.Inc,c.HeightMax.Value-y1)
+
+        grabbing = c.IsGrabbing()
+        if grabbing:
+            c.StopGrabbing()
+        # the offsets are cleared first, so that the size can grow
+        c.OffsetX = 0
+        c.OffsetY = 0
+        c.Width = width
+        c.Height = height
+        c.OffsetX = x1
+        c.OffsetY = y1
+        if grabbing:
+            self.last_block_id = None
+            c.StartGrabbing(pylon.GrabStrategy_OneByOne)
+        return self.get_roi()
+
+    def get_exposure_node(self):
+        # USB3 cameras call it ExposureTime, GigE cameras ExposureTimeAbs
+        try:
+            return self.camera.ExposureTime
+        except Exception as e:
+            return self.camera.ExposureTimeAbs
+
+    def get_exposure(self):
+        return self.get_exposure_node().Value
+
+    def set_exposure(self,exposure):
+        self.get_exposure_node().Value = exposure
 
+    def start(self,n_buffers=None):
+        """Grab continuously into a pool of n_buffers driver buffers (by
+        default ccfg.camera_grab_buffers), from which grab_into takes
+        frames in order (see acquisition.Acquisition)."""
+        if self.camera.IsGrabbing():
+            return
+        if n_buffers is None:
+            n_buffers = ccfg.camera_grab_buffers
+        self.camera.MaxNumBuffer = n_buffers
+        self.last_block_id = None
+        self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
 
-class SimulatedCamera:
+    def stop(self):
+        self.camera.StopGrabbing()
 
-    def __init__(self):
+    def grab_into(self,buffer=None):
+        """Copy the next frame into buffer (allocated in the camera's
+        native dtype, uint8 for Mono8 or uint16 for Mono12 and Mono16, if
+        None, or if its shape or dtype has changed), and return
+        (buffer,metadata). If the camera is not grabbing (see start), a
+        single frame is grabbed. While grabbing, frames the driver lost
+        are counted from gaps in the frame numbers (block IDs)."""
+        grabbing = self.camera.IsGrabbing()
+        if grabbing:
+            result = self.camera.RetrieveResult(self.timeout,pylon.TimeoutHandling_ThrowException)
+        else:
+            result = self.camera.GrabOne(self.timeout)
+        try:
+            if not result.GrabSucceeded():
+                raise RuntimeError('Grab failed: %s'%result.GetErrorDescription())
+            with result.GetArrayZeroCopy() as array:
+                if buffer is None or buffer.shape!=array.shape or buffer.dtype!=array.dtype:
+                    buffer = np.empty(array.shape,dtype=array.dtype)
+                np.copyto(buffer,array)
+            try:
+                camera_timestamp = result.ChunkTimestamp.Value
+            except Exception as e:
+                camera_timestamp = None
+            block_id = result.BlockID
+        finally:
+            result.Release()
+        if grabbing:
+            if self.last_block_id is not None and block_id>self.last_block_id+1:
+                self.n_dropped+=block_id-self.last_block_id-1
+            self.last_block_id = block_id
+        self.n_grabbed+=1
+        return buffer,FrameMetadata(block_id,time.time(),self.n_dropped,camera_timestamp)
+
+
+def load_frame_stack(image_list,cache_directory=None):
+    """Return the images in image_list as one read-only memory-mapped
+    (n_images,sy,sx) stack.
+
+    The stack is built once and cached in cache_directory (by default
+    ccfg.simulator_cache_directory), under a name derived from the image
+    filenames, sizes and modification times, so it is rebuilt only when
+    the source images change.
+    """
+    if cache_directory is None:
+        cache_directory = ccfg.simulator_cache_directory
+    key = hashlib.md5()
+    for fn in image_list:
+        st = os.stat(fn)
+        key.update('%s %d %d;'%(os.path.abspath(fn),st.st_size,int(st.st_mtime)))
+    stack_fn = os.path.join(cache_directory,'spots_%s.npy'%key.hexdigest())
+
+    if not os.path.exists(stack_fn):
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        # remove stacks built from an older set of images
+        for fn in glob.glob(os.path.join(cache_directory,'spots_*.npy')):
+            os.remove(fn)
+        print 'Caching %d simulator images in %s.'%(len(image_list),stack_fn)
+        first = np.load(image_list[0])
+        temp_fn = stack_fn+'.partial'
+        stack = np.lib.format.open_memmap(temp_fn,mode='w+',dtype=first.dtype,
+                                          shape=(len(image_list),)+first.shape)
+        for k,fn in enumerate(image_list):
+            stack[k] = np.load(fn)
+        stack.flush()
+        del stack
+        os.rename(temp_fn,stack_fn)
+
+    return np.load(stack_fn,mmap_mode='r')
+
+
+class SimulatedCamera(Camera):
+
+    def __init__(self,use_cache=None):
+        if use_cache is None:
+            use_cache = ccfg.simulated_camera_use_cache
         self.image_list = sorted(glob.glob(os.path.join(ccfg.simulated_camera_image_directory,'*.npy')))
         self.n_images = len(self.image_list)
         self.index = 0
-        #self.images = [np.load(fn) for fn in self.image_list]
+        if use_cache:
+            # images returned by get_image are read-only views into this stack
+            self.images = load_frame_stack(self.image_list)
+        else:
+            self.images = None
         self.opacity = False
         self.sy,self.sx = np.load(self.image_list[0]).shape
-        self.oy = int(round(np.random.rand()*self.sy//2+self.sy//4))
-        self.ox = int(round(np.random.rand()*self.sx//2+self.sx//4))
-        self.XX,self.YY = np.meshgrid(np.arange(self.sx),np.arange(self.sy))
+        Camera.__init__(self,self.sx,self.sy,ccfg.camera_exposure_us)
+        self.opacity_model = OpacityModel((self.sy,self.sx))
 
+    def set_roi(self,x,y,width,height):
+        """Return only the region (x,y,width,height) of the stored
+        images, as views, and return the region."""
+        x,y,width,height = Camera.set_roi(self,x,y,width,height)
+        self.opacity_model = OpacityModel((height,width))
+        return self.roi
 
     def set_opacity(self,val):
         self.opacity = val
 
     def get_opacity(self):
         return self.opacity
-            
-    def get_image(self):
-        im = np.load(self.image_list[self.index])
-        #im = self.images[self.index]
+
+    def next_image(self):
+        if self.images is not None:
+            im = self.images[self.index]
+        else:
+            im = np.load(self.image_list[self.index])
+        im = self.crop(im)
 
         if self.opacity:
             im = self.opacify(im)
-            self.oy = self.oy+np.random.randn()*.5
-            self.ox = self.ox+np.random.randn()*.5
 
         self.index = (self.index + 1)%self.n_images
         return im
-        
+
+    def get_image(self):
+        # no copy is made: the images are views into the stack
+        im = self.next_image()
+        self.metadata = self.make_metadata()
+        return im
+
+    def grab_into(self,buffer=None):
+        im = self.next_image()
+        if buffer is None or buffer.shape!=im.shape or buffer.dtype!=im.dtype:
+            buffer = np.empty(im.shape,dtype=im.dtype)
+        np.copyto(buffer,im)
+        return buffer,self.make_metadata()
     
-    def opacify(self,im,sigma=50):
-        xx,yy = self.XX-self.ox,self.YY-self.oy
-        d = np.sqrt(xx**2+yy**2)
-        #mask = np.exp((-d)/(2*sigma**2))
-        #mask = mask/mask.max()
-        #mask = 1-mask
-        mask = np.ones(d.shape)
-        mask[np.where(d<=sigma)] = 0.2
-        out = np.round(im*mask).astype(np.int16)
-        return out
+    def opacify(self,im):
+        return self.opacity_model.apply(im)
+
+
+class ReplayCamera(Camera):
+
+    def __init__(self,frames=None,frame_rate=None):
+        """A camera which replays frames held in memory, for running the
+        sensor and the pipeline without hardware, either as fast as the
+        consumer takes them or at a fixed frame rate.
+
+        Args:
+
+          frames (array): an (n_frames,height,width) stack of frames,
+            which is not copied; by default, the first
+            ccfg.replay_camera_n_frames images in
+            ccfg.simulated_camera_image_directory (all of them, if None),
+            memory-mapped from the simulator's frame stack (see
+            load_frame_stack), so they stay in the page cache after
+            the first pass
+
+          frame_rate (float): the camera's frame rate, in frames per
+            second; defaults to ccfg.replay_camera_frame_rate. If 0, every
+            frame is available as soon as it is requested. Otherwise,
+            grab_into waits for the next frame on the camera's clock, and
+            frames which came and went while nobody was grabbing are
+            dropped, as they would be by a real camera.
+        """
+        if frames is None:
+            image_list = sorted(glob.glob(os.path.join(ccfg.simulated_camera_image_directory,'*.npy')))
+            # the same stack as SimulatedCamera's, so the cache is shared
+            frames = load_frame_stack(image_list)[:ccfg.replay_camera_n_frames]
+        if frame_rate is None:
+            frame_rate = ccfg.replay_camera_frame_rate
+        # images returned by get_image are read-only views into the
+        # frames; the flag is cleared on a view, so the caller's array
+        # is unaffected
+        self.frames = np.asarray(frames).view()
+        self.frames.flags.writeable = False
+        self.n_frames,height,width = self.frames.shape
+        Camera.__init__(self,width,height,ccfg.camera_exposure_us)
+        self.frame_rate = float(frame_rate)
+        self.start_time = None
+        self.clock_frame = 0
+
+    def start(self,n_buffers=None):
+        # restart the camera's clock
+        self.start_time = None
+
+    def wait_for_frame(self):
+        # Frame k after the clock starts is read out at start_time+k/
+        # frame_rate. Wait for the next frame, or, if newer frames have
+        # been read out since, skip to the newest, dropping the others.
+        if self.frame_rate<=0:
+            return
+        t = time.time()
+        if self.start_time is None:
+            self.start_time = t
+            self.clock_frame = 0
+        newest = int((t-self.start_time)*self.frame_rate)
+        if newest>self.clock_frame:
+            self.n_dropped+=newest-self.clock_frame
+            self.clock_frame = newest
+        elif newest<self.clock_frame:
+            time.sleep(self.start_time+self.clock_frame/self.frame_rate-t)
+        self.clock_frame+=1
+
+    def next_image(self):
+        self.wait_for_frame()
+        return self.crop(self.frames[(self.n_grabbed+self.n_dropped)%self.n_frames])
+
+    def get_image(self):
+        # no copy is made: the images are views into the frames
+        im = self.next_image()
+        self.metadata = self.make_metadata()
+        return im
+
+    def grab_into(self,buffer=None):
+        im = self.next_image()
+        if buffer is None or buffer.shape!=im.shape or buffer.dtype!=im.dtype:
+            buffer = np.empty(im.shape,dtype=im.dtype)
+        np.copyto(buffer,im)
+        return buffer,self.make_metadata()
+
+
+# camera classes (or functions returning cameras) by name; see
+# register_camera and get_camera
+camera_classes = {}
+
+def register_camera(name,camera_class):
+    """Make camera_class, or any function returning a camera, available
+    to get_camera as name."""
+    camera_classes[name.lower()] = camera_class
+
+def get_camera(name=None,acquisition=None,**kwargs):
+    """Create the camera registered as name, passing it kwargs.
+
+    Args:
+
+      name (str): the camera's name; defaults to ccfg.camera_backend
+
+      acquisition (bool): if True, the camera is wrapped in a started
+        Acquisition, which grabs frames on its own thread; defaults to
+        ccfg.camera_use_acquisition
+    """
+    if name is None:
+        name = ccfg.camera_backend
+    if acquisition is None:
+        acquisition = ccfg.camera_use_acquisition
+    name = name.lower()
+    if name not in camera_classes:
+        raise ValueError('Unknown camera \'%s\'; choose one of %s.'%(name,', '.join(['\'%s\''%key for key in sorted(camera_classes)])))
+    camera = camera_classes[name](**kwargs)
+    if acquisition:
+        camera = Acquisition(camera)
+        camera.start()
+    return camera
+
+register_camera('pylon',PylonCamera)
+register_camera('simulated',SimulatedCamera)
+register_camera('synthetic',SyntheticCamera)
+register_camera('replay',ReplayCamera)
@@ -1,13 +1,248 @@
 import numpy as np
 cimport numpy as np
-from matplotlib import pyplot as plt
 import cython
 from cython.parallel import prange
+from libc.math cimport rint, INFINITY
 ctypedef np.uint16_t uint16_t
 
+np.import_array()
+
+# Images are centroided in the camera's native pixel format; the processed
+# (background-subtracted) image, if requested, has the same format. The
+# kernels take raw pointers and strides rather than memoryviews, since
+# memoryviews of read-only images (e.g. SimulatedCamera's memory-mapped
+# frames) must be const, and const fused memoryviews aren't supported by
+# Cython 0.29.
+ctypedef fused pixel_t:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+
+ctypedef struct box_params:
+    # strides of the spots image and the processed image, in elements
+    Py_ssize_t row_stride
+    Py_ssize_t col_stride
+    Py_ssize_t out_row_stride
+    Py_ssize_t out_col_stride
+    np.int_t estimate_background
+    np.float_t background_correction
+    # the largest value of the pixel type, at which processed pixels
+    # saturate
+    np.float_t pixel_max
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
+cdef inline int centroid_box(pixel_t *spots_image,
+                             pixel_t *out_image,
+                             box_params *params,
+                             np.int_t x1, np.int_t x2,
+                             np.int_t y1, np.int_t y2,
+                             np.float_t *x_centroid,
+                             np.float_t *y_centroid,
+                             np.float_t *mean_intensity,
+                             np.float_t *maximum_intensity,
+                             np.float_t *minimum_intensity,
+                             np.float_t *background_intensity) nogil:
+    # Compute the centroid of a single search box, bounded inclusively
+    # by x1, x2, y1 and y2. Returns 1 and fills the output pointers if
+    # the box contains light after background subtraction, or 0 and
+    # leaves them untouched otherwise. spots_image is only read. If
+    # out_image is not NULL, the background-subtracted pixels are
+    # written into it, clipped to the range of the pixel type (the
+    # background correction may be negative, raising them above the
+    # input's maximum).
+    cdef np.float_t intensity = 0.0
+    cdef np.float_t background = 0.0
+    cdef np.float_t xprod = 0.0
+    cdef np.float_t yprod = 0.0
+    cdef np.float_t imin = INFINITY
+    cdef np.float_t imax = -INFINITY
+    cdef np.float_t pixel
+    cdef np.float_t edge_counter = 0.0
+    cdef np.float_t counter = 0.0
+    cdef np.int_t x
+    cdef np.int_t y
+    cdef Py_ssize_t rs = params.row_stride
+    cdef Py_ssize_t cs = params.col_stride
+
+    if params.estimate_background:
+        for x in range(x1,x2+1):
+            background = background + <np.float_t>spots_image[y1*rs+x*cs]
+            background = background + <np.float_t>spots_image[y2*rs+x*cs]
+            edge_counter = edge_counter + 2.0
+        for y in range(y1+1,y2):
+            background = background + <np.float_t>spots_image[y*rs+x1*cs]
+            background = background + <np.float_t>spots_image[y*rs+x2*cs]
+            edge_counter = edge_counter + 2.0
+        background = background/edge_counter
+
+    # iterate over rows in the outer loop, so that the inner loop
+    # walks along contiguous memory
+    for y in range(y1,y2+1):
+        for x in range(x1,x2+1):
+            pixel = <np.float_t>spots_image[y*rs+x*cs]-(background+params.background_correction)
+            if pixel<0.0:
+                pixel = 0.0
+            if out_image!=NULL:
+                out_image[y*params.out_row_stride+x*params.out_col_stride] = <pixel_t>min(pixel,params.pixel_max)
+            xprod = xprod + pixel*x
+            yprod = yprod + pixel*y
+            intensity = intensity + pixel
+            if pixel<imin:
+                imin = pixel
+            if pixel>imax:
+                imax = pixel
+            counter = counter + 1.0
+
+    # If the search box is empty after background subtraction
+    # (check background_correction), don't report a spurious centroid.
+    if xprod==0 or yprod==0:
+        return 0
+    x_centroid[0] = xprod/intensity
+    y_centroid[0] = yprod/intensity
+    mean_intensity[0] = intensity/counter
+    maximum_intensity[0] = imax
+    minimum_intensity[0] = imin
+    background_intensity[0] = background
+    return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void centroid_boxes(pixel_t *spots_image,
+                         pixel_t *out_image,
+                         box_params *params,
+                         np.int16_t[:] sb_x1_vec,
+                         np.int16_t[:] sb_x2_vec,
+                         np.int16_t[:] sb_y1_vec,
+                         np.int16_t[:] sb_y2_vec,
+                         np.float_t[:] x_out,
+                         np.float_t[:] y_out,
+                         np.float_t[:] mean_intensity,
+                         np.float_t[:] maximum_intensity,
+                         np.float_t[:] minimum_intensity,
+                         np.float_t[:] background_intensity,
+                         np.int_t num_threads):
+    cdef np.int_t n_spots = sb_x1_vec.shape[0]
+    cdef np.int_t k
+
+    # Each lenslet is handled by exactly one thread, and each box is
+    # summed in the same order regardless of num_threads, so the output
+    # does not depend on the number of threads. With a processed image,
+    # the search boxes must not overlap, since the threads write into
+    # it.
+    for k in prange(n_spots,nogil=True,num_threads=num_threads,schedule='static'):
+        centroid_box(spots_image,out_image,params,
+                     sb_x1_vec[k],sb_x2_vec[k],
+                     sb_y1_vec[k],sb_y2_vec[k],
+                     &x_out[k],&y_out[k],
+                     &mean_intensity[k],
+                     &maximum_intensity[k],
+                     &minimum_intensity[k],
+                     &background_intensity[k])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void centroid_boxes_iterative(pixel_t *spots_image,
+                                   pixel_t *out_image,
+                                   box_params *params,
+                                   np.int_t xmax,
+                                   np.int_t ymax,
+                                   np.float_t[:] x_in,
+                                   np.float_t[:] y_in,
+                                   np.float_t half_width,
+                                   np.float_t step,
+                                   np.int_t n_iterations,
+                                   np.float_t[:] x_out,
+                                   np.float_t[:] y_out,
+                                   np.float_t[:] mean_intensity,
+                                   np.float_t[:] maximum_intensity,
+                                   np.float_t[:] minimum_intensity,
+                                   np.float_t[:] background_intensity,
+                                   np.int_t num_threads):
+    cdef np.int_t n_spots = x_in.shape[0]
+    cdef np.int_t k
+    cdef np.int_t iteration
+    cdef np.float_t hw
+    cdef np.float_t xc
+    cdef np.float_t yc
+    cdef np.int_t x1
+    cdef np.int_t x2
+    cdef np.int_t y1
+    cdef np.int_t y2
+    cdef pixel_t *last_out_image
+
+    for k in prange(n_spots,nogil=True,num_threads=num_threads,schedule='static'):
+        xc = x_in[k]
+        yc = y_in[k]
+        hw = half_width
+        for iteration in range(n_iterations):
+            x1 = <np.int_t>rint(xc-hw)
+            x2 = <np.int_t>rint(xc+hw)
+            y1 = <np.int_t>rint(yc-hw)
+            y2 = <np.int_t>rint(yc+hw)
+            if x1<0:
+                x1 = 0
+            if y1<0:
+                y1 = 0
+            if x2>xmax:
+                x2 = xmax
+            if y2>ymax:
+                y2 = ymax
+            if x2<x1 or y2<y1:
+                break
+            if iteration==n_iterations-1:
+                last_out_image = out_image
+            else:
+                last_out_image = NULL
+            centroid_box(spots_image,last_out_image,params,
+                         x1,x2,y1,y2,
+                         &xc,&yc,
+                         &mean_intensity[k],
+                         &maximum_intensity[k],
+                         &minimum_intensity[k],
+                         &background_intensity[k])
+            hw = hw-step
+        x_out[k] = xc
+        y_out[k] = yc
+
+
+cdef get_images(spots_image,processed_image,modify_spots_image,box_params *params):
+    # Return spots_image and the processed image (or None) as arrays, and
+    # fill in their strides. modify_spots_image makes spots_image its own
+    # processed image.
+    spots_image = np.asarray(spots_image)
+    if spots_image.ndim!=2:
+        raise ValueError('spots_image must be two-dimensional.')
+    if spots_image.dtype not in (np.uint8,np.uint16,np.int16):
+        raise TypeError('Unsupported pixel type %s; use uint8, uint16 or int16.'%spots_image.dtype)
+    if modify_spots_image and processed_image is None:
+        processed_image = spots_image
+    params.pixel_max = np.iinfo(spots_image.dtype).max
+    params.row_stride = spots_image.strides[0]//spots_image.itemsize
+    params.col_stride = spots_image.strides[1]//spots_image.itemsize
+    params.out_row_stride = 0
+    params.out_col_stride = 0
+    if processed_image is not None:
+        if processed_image.shape!=spots_image.shape or processed_image.dtype!=spots_image.dtype:
+            raise ValueError('processed_image must have the shape and pixel type of spots_image.')
+        if not processed_image.flags.writeable:
+            raise ValueError('processed_image is not writable.')
+        params.out_row_stride = processed_image.strides[0]//processed_image.itemsize
+        params.out_col_stride = processed_image.strides[1]//processed_image.itemsize
+    return spots_image,processed_image
+
+
+cdef inline void *get_data(image):
+    if image is None:
+        return NULL
+    return np.PyArray_DATA(image)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef compute_centroids(spots_image,
                         np.ndarray[np.int16_t,ndim=1] sb_x1_vec,
                         np.ndarray[np.int16_t,ndim=1] sb_x2_vec,
                         np.ndarray[np.int16_t,ndim=1] sb_y1_vec,
@@ -21,94 +256,99 @@ cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
                         estimate_background = True,
                         background_correction = 0.0,
                         num_threads = 4,
-                        modify_spots_image = False):
+                        modify_spots_image = False,
+                        processed_image = None):
+    """Centroid the spots in the given search boxes.
 
-    cdef np.int_t n_spots = len(sb_x1_vec)
-    cdef np.int_t k
-    cdef np.int_t num_threads_t = int(num_threads)
-    cdef np.float_t intensity
-    cdef np.float_t background
-    cdef np.float_t xprod
-    cdef np.float_t yprod
-    cdef np.int_t x
-    cdef np.int_t y
-    cdef np.float_t imax
-    cdef np.float_t imin
-    cdef np.float_t pixel
-    cdef np.float_t edge_counter
-    cdef np.int_t estimate_background_t
-    cdef np.int_t modify_spots_image_t
-    cdef np.float_t background_correction_t
-    cdef np.float_t counter
-
-    # if modify_spots_image:
-    #     modify_spots_image_t = 1
-    # else:
-    #     modify_spots_image_t = 0
-    
-    # if estimate_background:
-    #     estimate_background_t = 1
-    # else:
-    #     estimate_background_t = 0
-
-    modify_spots_image_t = int(modify_spots_image)
-    estimate_background_t = int(estimate_background)
-
-    background_correction_t = float(background_correction)
-    num_threads_t = int(num_threads)
-    
-    #for k in prange(n_spots,nogil=True,num_threads=num_threads_t):
-    for k in range(n_spots):
-        if estimate_background_t:
-            edge_counter = 0.0
-            background = 0.0
-            for x in range(sb_x1_vec[k],sb_x2_vec[k]+1):
-                pixel = float(spots_image[sb_y1_vec[k],x])
-                background = background + pixel
-                edge_counter = edge_counter + 1
-                pixel = float(spots_image[sb_y2_vec[k],x])
-                background = background + pixel
-                edge_counter = edge_counter + 1
-            for y in range(sb_y1_vec[k]+1,sb_y2_vec[k]):
-                pixel = float(spots_image[y,sb_x1_vec[k]])
-                background = background + pixel
-                edge_counter = edge_counter + 1
-                pixel = float(spots_image[y,sb_x1_vec[k]])
-                background = background + pixel
-                edge_counter = edge_counter + 1
-            background = background/edge_counter
-        else:
-            background = 0.0
-        intensity = 0.0
-        xprod = 0.0
-        yprod = 0.0
-        imin = 2**15
-        imax = -2**15
-        for x in range(sb_x1_vec[k],sb_x2_vec[k]+1):
-            for y in range(sb_y1_vec[k],sb_y2_vec[k]+1):
-                pixel = float(spots_image[y,x])-(background+background_correction_t)
-                if pixel<0.0:
-                    pixel = 0.0
-                if modify_spots_image_t:
-                    spots_image[y,x] = <np.int_t>pixel
-                xprod = xprod + pixel*x
-                yprod = yprod + pixel*y
-                intensity = intensity + pixel
-                if pixel<imin:
-                    imin=pixel
-                if pixel>imax:
-                    imax=pixel
-                counter = counter + 1.0
-
-        if xprod==0 or yprod==0:
-            print 'Warning: search box intensity low; skipping. Check background_correction.'
-            continue
-        mean_intensity[k] = intensity/counter
-        background_intensity[k] = background
-        maximum_intensity[k] = imax
-        minimum_intensity[k] = imin
-        if intensity==0.0:
-            intensity = 1.0
-        x_out[k] = xprod/intensity
-        y_out[k] = yprod/intensity
+    spots_image may be uint8, uint16 or int16, and is not modified. The
+    background-subtracted search boxes are written into processed_image,
+    if given, an array of the same shape and pixel type; the pixels
+    outside the boxes are left untouched. modify_spots_image writes them
+    into spots_image instead, which must then be writable.
+    """
+    cdef box_params params
+    cdef np.int_t num_threads_t = max(int(num_threads),1)
+    params.estimate_background = int(estimate_background)
+    params.background_correction = float(background_correction)
+    spots_image,processed_image = get_images(spots_image,processed_image,modify_spots_image,&params)
+    cdef void *data = get_data(spots_image)
+    cdef void *out_data = get_data(processed_image)
+
+    if spots_image.dtype==np.uint8:
+        centroid_boxes[np.uint8_t](<np.uint8_t*>data,<np.uint8_t*>out_data,&params,
+                       sb_x1_vec,sb_x2_vec,sb_y1_vec,sb_y2_vec,
+                       x_out,y_out,mean_intensity,maximum_intensity,
+                       minimum_intensity,background_intensity,num_threads_t)
+    elif spots_image.dtype==np.uint16:
+        centroid_boxes[np.uint16_t](<np.uint16_t*>data,<np.uint16_t*>out_data,&params,
+                       sb_x1_vec,sb_x2_vec,sb_y1_vec,sb_y2_vec,
+                       x_out,y_out,mean_intensity,maximum_intensity,
+                       minimum_intensity,background_intensity,num_threads_t)
+    else:
+        centroid_boxes[np.int16_t](<np.int16_t*>data,<np.int16_t*>out_data,&params,
+                       sb_x1_vec,sb_x2_vec,sb_y1_vec,sb_y2_vec,
+                       x_out,y_out,mean_intensity,maximum_intensity,
+                       minimum_intensity,background_intensity,num_threads_t)
+    return x_out,y_out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef compute_centroids_iterative(spots_image,
+                                  np.ndarray[np.float_t,ndim=1] x_in,
+                                  np.ndarray[np.float_t,ndim=1] y_in,
+                                  half_width,
+                                  step,
+                                  n_iterations,
+                                  np.ndarray[np.float_t,ndim=1] x_out,
+                                  np.ndarray[np.float_t,ndim=1] y_out,
+                                  np.ndarray[np.float_t,ndim=1] mean_intensity,
+                                  np.ndarray[np.float_t,ndim=1] maximum_intensity,
+                                  np.ndarray[np.float_t,ndim=1] minimum_intensity,
+                                  np.ndarray[np.float_t,ndim=1] background_intensity,
+                                  estimate_background = True,
+                                  background_correction = 0.0,
+                                  num_threads = 4,
+                                  modify_spots_image = False,
+                                  processed_image = None):
+    """Iteratively centroid all lenslets in a single call.
+
+    Search boxes are centered on (x_in,y_in) with the given half_width
+    for the first iteration; for each subsequent iteration, every box is
+    re-centered on its previous centroid and its half width is reduced
+    by step. This is equivalent to calling compute_centroids
+    n_iterations times and building new SearchBoxes between calls, but
+    the boxes are computed in C, without allocating any Python objects.
+    Box edges are rounded like SearchBoxes (half to even) and clipped to
+    the image. The processed image (see compute_centroids) is only
+    written in the last iteration.
+    """
+    cdef box_params params
+    cdef np.int_t num_threads_t = max(int(num_threads),1)
+    cdef np.int_t n_iterations_t = int(n_iterations)
+    cdef np.float_t half_width_t = float(half_width)
+    cdef np.float_t step_t = float(step)
+    params.estimate_background = int(estimate_background)
+    params.background_correction = float(background_correction)
+    spots_image,processed_image = get_images(spots_image,processed_image,modify_spots_image,&params)
+    cdef void *data = get_data(spots_image)
+    cdef void *out_data = get_data(processed_image)
+    cdef np.int_t xmax = spots_image.shape[1]-1
+    cdef np.int_t ymax = spots_image.shape[0]-1
+
+    if spots_image.dtype==np.uint8:
+        centroid_boxes_iterative[np.uint8_t](<np.uint8_t*>data,<np.uint8_t*>out_data,&params,
+                                 xmax,ymax,x_in,y_in,half_width_t,step_t,n_iterations_t,
+                                 x_out,y_out,mean_intensity,maximum_intensity,
+                                 minimum_intensity,background_intensity,num_threads_t)
+    elif spots_image.dtype==np.uint16:
+        centroid_boxes_iterative[np.uint16_t](<np.uint16_t*>data,<np.uint16_t*>out_data,&params,
+                                 xmax,ymax,x_in,y_in,half_width_t,step_t,n_iterations_t,
+                                 x_out,y_out,mean_intensity,maximum_intensity,
+                                 minimum_intensity,background_intensity,num_threads_t)
+    else:
+        centroid_boxes_iterative[np.int16_t](<np.int16_t*>data,<np.int16_t*>out_data,&params,
+                                 xmax,ymax,x_in,y_in,half_width_t,step_t,n_iterations_t,
+                                 x_out,y_out,mean_intensity,maximum_intensity,
+                                 minimum_intensity,background_intensity,num_threads_t)
     return x_out,y_out
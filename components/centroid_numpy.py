@@ -0,0 +1,256 @@
+"""A pure NumPy implementation of the centroid module.
+
+This module mirrors the interface of the compiled (Cython) centroid
+module, so that either can be used by the sensor. Instead of looping over
+search boxes, all boxes of a given size are gathered from a strided
+(n_lenslets x height x width) view of the spots image, and the background,
+moments, minimum, maximum and mean of every box are computed with a
+handful of array operations. It is slower than the compiled module, but
+far faster than looping over boxes in Python, and it needs no build step.
+
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def get_windows(spots_image,height,width):
+    """Return a view of every height x width window in spots_image.
+
+    The returned array has shape (sy-height+1,sx-width+1,height,width),
+    and windows[y1,x1] is the window whose upper left pixel is (y1,x1). No
+    data are copied, and indexing the view with vectors of y1 and x1 gathers
+    a (n_boxes,height,width) stack of search boxes.
+    """
+    sy,sx = spots_image.shape
+    s0,s1 = spots_image.strides
+    return as_strided(spots_image,shape=(sy-height+1,sx-width+1,height,width),
+                      strides=(s0,s1,s0,s1))
+
+def get_processed_image(spots_image,processed_image,modify_spots_image):
+    # modify_spots_image makes spots_image its own processed image
+    if processed_image is None and modify_spots_image:
+        processed_image = spots_image
+    if processed_image is not None and processed_image.shape!=spots_image.shape:
+        raise ValueError('processed_image must have the same shape as spots_image.')
+    return processed_image
+
+def to_pixels(boxes,dtype):
+    # convert background-subtracted pixels to dtype, saturating at its
+    # maximum, since a negative background correction may raise them
+    # above the input's range
+    if np.dtype(dtype).kind in 'iu':
+        boxes = np.clip(boxes,0,np.iinfo(dtype).max)
+    return boxes.astype(dtype)
+
+def centroid_windows(spots_image,x1,y1,height,width,
+                     estimate_background=True,
+                     background_correction=0.0,
+                     processed_image=None):
+    """Centroid a set of equally sized search boxes.
+
+    Args:
+
+      spots_image (2D array): the spots image
+
+      x1, y1 (int arrays): the left and top edges of the search boxes
+
+      height, width (int): the size of every search box, in pixels
+
+      processed_image (2D array): if given, the background-subtracted
+        boxes are written into it
+
+    Returns:
+
+      tuple: (x,y,mean,maximum,minimum,background,valid), each a vector
+        with one element per box; valid is False for boxes that are
+        empty after background subtraction.
+    """
+    windows = get_windows(spots_image,height,width)
+    boxes = windows[y1,x1].astype(np.float)
+
+    if estimate_background:
+        edges = np.concatenate((boxes[:,0,:],boxes[:,-1,:],
+                                boxes[:,1:-1,0],boxes[:,1:-1,-1]),axis=1)
+        background = edges.mean(axis=1)
+    else:
+        background = np.zeros(len(x1))
+
+    boxes-=(background+background_correction)[:,np.newaxis,np.newaxis]
+    np.maximum(boxes,0.0,out=boxes)
+
+    if processed_image is not None:
+        get_windows(processed_image,height,width)[y1,x1] = to_pixels(boxes,processed_image.dtype)
+
+    x_coords = x1[:,np.newaxis]+np.arange(width)
+    y_coords = y1[:,np.newaxis]+np.arange(height)
+    xprod = np.sum(boxes.sum(axis=1)*x_coords,axis=1)
+    yprod = np.sum(boxes.sum(axis=2)*y_coords,axis=1)
+    intensity = boxes.sum(axis=(1,2))
+    valid = (xprod!=0)&(yprod!=0)
+    intensity[np.where(intensity==0)] = 1.0
+
+    return (xprod/intensity,yprod/intensity,
+            intensity/float(height*width),
+            boxes.max(axis=(1,2)),boxes.min(axis=(1,2)),
+            background,valid)
+
+def centroid_boxes(spots_image,x1,x2,y1,y2,x_out,y_out,
+                   mean_intensity,maximum_intensity,
+                   minimum_intensity,background_intensity,
+                   estimate_background,background_correction,
+                   processed_image):
+    # Search boxes normally all have the same size, but group them by
+    # size in case rounding or clipping has made some of them differ.
+    # Outputs are only written for boxes that contain light.
+    heights = y2-y1+1
+    widths = x2-x1+1
+    for height,width in set(zip(heights,widths)):
+        idx = np.where((heights==height)&(widths==width))[0]
+        x,y,mean,maximum,minimum,background,valid = centroid_windows(
+            spots_image,x1[idx],y1[idx],height,width,
+            estimate_background,background_correction,processed_image)
+        idx = idx[valid]
+        x_out[idx] = x[valid]
+        y_out[idx] = y[valid]
+        mean_intensity[idx] = mean[valid]
+        maximum_intensity[idx] = maximum[valid]
+        minimum_intensity[idx] = minimum[valid]
+        background_intensity[idx] = background[valid]
+
+def compute_centroids(spots_image,
+                      sb_x1_vec,
+                      sb_x2_vec,
+                      sb_y1_vec,
+                      sb_y2_vec,
+                      x_out,
+                      y_out,
+                      mean_intensity,
+                      maximum_intensity,
+                      minimum_intensity,
+                      background_intensity,
+                      estimate_background = True,
+                      background_correction = 0.0,
+                      num_threads = 4,
+                      modify_spots_image = False,
+                      processed_image = None):
+    """NumPy equivalent of centroid.compute_centroids; num_threads is
+    accepted for compatibility and ignored."""
+    processed_image = get_processed_image(spots_image,processed_image,modify_spots_image)
+    centroid_boxes(spots_image,
+                   sb_x1_vec.astype(np.intp),sb_x2_vec.astype(np.intp),
+                   sb_y1_vec.astype(np.intp),sb_y2_vec.astype(np.intp),
+                   x_out,y_out,mean_intensity,maximum_intensity,
+                   minimum_intensity,background_intensity,
+                   estimate_background,float(background_correction),
+                   processed_image)
+    return x_out,y_out
+
+def compute_centroids_iterative(spots_image,
+                                x_in,
+                                y_in,
+                                half_width,
+                                step,
+                                n_iterations,
+                                x_out,
+                                y_out,
+                                mean_intensity,
+                                maximum_intensity,
+                                minimum_intensity,
+                                background_intensity,
+                                estimate_background = True,
+                                background_correction = 0.0,
+                                num_threads = 4,
+                                modify_spots_image = False,
+                                processed_image = None):
+    """NumPy equivalent of centroid.compute_centroids_iterative;
+    num_threads is accepted for compatibility and ignored."""
+    processed_image = get_processed_image(spots_image,processed_image,modify_spots_image)
+    sy,sx = spots_image.shape
+    x_out[:] = x_in
+    y_out[:] = y_in
+    active = np.arange(len(x_in))
+    hw = float(half_width)
+    for iteration in range(n_iterations):
+        x1 = np.clip(np.round(x_out[active]-hw),0,sx-1).astype(np.intp)
+        x2 = np.clip(np.round(x_out[active]+hw),0,sx-1).astype(np.intp)
+        y1 = np.clip(np.round(y_out[active]-hw),0,sy-1).astype(np.intp)
+        y2 = np.clip(np.round(y_out[active]+hw),0,sy-1).astype(np.intp)
+        # boxes that have shrunk away stop iterating
+        valid = np.where((x2>=x1)&(y2>=y1))[0]
+        active = active[valid]
+        if len(active)==0:
+            break
+        x_temp = x_out[active]
+        y_temp = y_out[active]
+        mean_temp = mean_intensity[active]
+        max_temp = maximum_intensity[active]
+        min_temp = minimum_intensity[active]
+        background_temp = background_intensity[active]
+        centroid_boxes(spots_image,x1[valid],x2[valid],y1[valid],y2[valid],
+                       x_temp,y_temp,mean_temp,max_temp,min_temp,background_temp,
+                       estimate_background,float(background_correction),
+                       processed_image if iteration==n_iterations-1 else None)
+        x_out[active] = x_temp
+        y_out[active] = y_temp
+        mean_intensity[active] = mean_temp
+        maximum_intensity[active] = max_temp
+        minimum_intensity[active] = min_temp
+        background_intensity[active] = background_temp
+        hw = hw-step
+    return x_out,y_out
+
+def compute_centroids_indexed(spots_image,
+                              index_tables,
+                              x_out,
+                              y_out,
+                              mean_intensity,
+                              maximum_intensity,
+                              minimum_intensity,
+                              background_intensity,
+                              estimate_background = True,
+                              background_correction = 0.0,
+                              modify_spots_image = False,
+                              processed_image = None):
+    """Centroid using the cached tables from SearchBoxes.get_index_tables.
+
+    Equivalent to compute_centroids, but the search box pixels are
+    gathered with precomputed flat indices, so no per-frame setup (box
+    edges, coordinate grids) is required.
+    """
+    processed_image = get_processed_image(spots_image,processed_image,modify_spots_image)
+    flat_image = spots_image.ravel()
+    pixel_index = index_tables['pixel_index']
+    boxes = flat_image[pixel_index].astype(np.float)
+
+    if estimate_background:
+        background = flat_image[index_tables['edge_index']].mean(axis=1)
+    else:
+        background = np.zeros(len(pixel_index))
+
+    boxes-=(background+background_correction)[:,np.newaxis]
+    np.maximum(boxes,0.0,out=boxes)
+
+    height,width = index_tables['height'],index_tables['width']
+    boxes_2d = boxes.reshape(-1,height,width)
+
+    if processed_image is not None:
+        # scattering through the strided window view is much faster
+        # than assigning through the flat indices
+        x1 = index_tables['x1']
+        y1 = index_tables['y1']
+        get_windows(processed_image,height,width)[y1,x1] = to_pixels(boxes_2d,processed_image.dtype)
+
+    # collapse each box along one axis before weighting by the other
+    # coordinate, using the first row and column of the coordinate grids
+    xprod = np.sum(boxes_2d.sum(axis=1)*index_tables['x_grid'][:,:width],axis=1)
+    yprod = np.sum(boxes_2d.sum(axis=2)*index_tables['y_grid'][:,::width],axis=1)
+    intensity = boxes.sum(axis=1)
+    valid = np.where((xprod!=0)&(yprod!=0))[0]
+
+    x_out[valid] = xprod[valid]/intensity[valid]
+    y_out[valid] = yprod[valid]/intensity[valid]
+    mean_intensity[valid] = intensity[valid]/float(boxes.shape[1])
+    maximum_intensity[valid] = boxes.max(axis=1)[valid]
+    minimum_intensity[valid] = boxes.min(axis=1)[valid]
+    background_intensity[valid] = background[valid]
+    return x_out,y_out
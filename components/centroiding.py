@@ -0,0 +1,37 @@
+"""Selection of the centroiding backend.
+
+Two interchangeable backends implement compute_centroids and
+compute_centroids_iterative: the compiled centroid module (see
+components/centroid), and centroid_numpy, which needs no build step. The
+backend is chosen by ccfg.centroiding_backend: 'cython', 'numpy', or
+'auto', which uses the compiled module if it can be imported and falls
+back to NumPy otherwise.
+
+"""
+
+from ciao import config as ccfg
+import centroid_numpy
+
+try:
+    import centroid as centroid_cython
+except ImportError as ie:
+    centroid_cython = None
+
+def get_backend(name=None):
+    if name is None:
+        name = ccfg.centroiding_backend
+    name = name.lower()
+    if name=='auto':
+        if centroid_cython is not None:
+            name = 'cython'
+        else:
+            print 'Compiled centroid module not found. Using NumPy centroiding.'
+            name = 'numpy'
+    if name=='cython':
+        if centroid_cython is None:
+            raise ImportError('Compiled centroid module not found. Please build it with components/centroid/rebuild.sh.')
+        return centroid_cython
+    elif name=='numpy':
+        return centroid_numpy
+    else:
+        raise ValueError('Unknown centroiding backend \'%s\'; choose \'auto\', \'cython\' or \'numpy\'.'%name)
@@ -1,6 +1,5 @@
 import numpy as np
 import time
-import centroid
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -25,7 +24,8 @@ from search_boxes import SearchBoxes
 from reference_generator import ReferenceGenerator
 from ciao import config as ccfg
 from frame_timer import FrameTimer
-from poke import Poke
+from poke import Poke, CtrlSolver
+from poke_acquisition import PokeAcquisition
 
 sensor_mutex = QMutex()
 mirror_mutex = QMutex()
@@ -74,6 +74,8 @@ class Loop(QObject):
         self.unpause_signal.connect(self.sensor.unpause)
         self.unpause_signal.connect(self.mirror.unpause)
         self.poke = None
+        self.ctrl_solver = None
+        self.poke_acquisition = None
         self.closed = False
         
         try:
@@ -110,22 +112,38 @@ class Loop(QObject):
             mirror_mutex.lock()
             # compute the mirror command here
             if self.closed and self.has_poke():
-                current_active_lenslets = np.zeros(self.active_lenslets.shape)
-                current_active_lenslets[np.where(self.sensor.box_maxes>ccfg.spots_threshold)] = 1
-                if not all(self.active_lenslets==current_active_lenslets):
-                    self.active_lenslets[:] = current_active_lenslets[:]
-                    self.poke.invert(mask=self.active_lenslets)
-
-                xs = self.sensor.x_slopes[np.where(self.active_lenslets)[0]]
-                ys = self.sensor.y_slopes[np.where(self.active_lenslets)[0]]
-                slope_vec = np.hstack((xs,ys))
-                command = self.gain * np.dot(self.poke.ctrl,slope_vec)
-                command = self.mirror.get_command()*(1-self.loss) - command
+                frame = self.sensor.get_frame()
+                command = self.compute_command(frame,self.mirror.get_command().copy())
                 self.mirror.set_command(command)
                 
             self.finished.emit()
             sensor_mutex.unlock()
             mirror_mutex.unlock()
+
+    def compute_command(self,frame,command):
+        """Update command, in place, with the correction for the slopes
+        in frame, and return it."""
+        current_active_lenslets = np.zeros(self.active_lenslets.shape)
+        current_active_lenslets[np.where(frame.box_maxes>ccfg.spots_threshold)] = 1
+        if not all(self.active_lenslets==current_active_lenslets):
+            self.active_lenslets[:] = current_active_lenslets[:]
+            self.ctrl_solver.request(self.active_lenslets)
+            self.ctrl_matrix = None
+
+        # Until the solver has a matrix for the current lenslets,
+        # apply the last one, restricted to the lenslets that are
+        # still active.
+        ctrl_matrix = self.ctrl_solver.get()
+        if ctrl_matrix is not self.ctrl_matrix:
+            self.ctrl_matrix = ctrl_matrix
+            self.ctrl_lenslets,self.ctrl = ctrl_matrix.restrict(self.active_lenslets)
+
+        xs = frame.x_slopes[self.ctrl_lenslets]
+        ys = frame.y_slopes[self.ctrl_lenslets]
+        slope_vec = np.hstack((xs,ys))
+        command*=(1-self.loss)
+        command-=self.gain*np.dot(self.ctrl,slope_vec)
+        return command
                 
     def load_poke(self,poke_filename=None):
         sensor_mutex.lock()
@@ -155,24 +173,32 @@ class Loop(QObject):
             error_message('Poke matrix has shape (%d,%d), but (%d,%d) was expected. Using dummy matrix.'%(py,px,expected_py,expected_px))
             poke = dummy
             
-        self.poke = Poke(poke)
+        self.set_poke(poke)
 
         sensor_mutex.unlock()
         mirror_mutex.unlock()
 
+    def set_poke(self,poke):
+        if self.ctrl_solver is not None:
+            self.ctrl_solver.stop()
+        self.poke = Poke(poke)
+        self.ctrl_solver = CtrlSolver(self.poke)
+        self.ctrl_matrix = None
+        if not all(self.active_lenslets):
+            self.ctrl_solver.request(self.active_lenslets)
+
     def invert(self):
+        # The solver computes the matrix on its own thread and the loop
+        # picks it up on a later update, so there's no need to pause.
         if self.poke is not None:
-            self.pause()
-            time.sleep(1)
-            self.poke.invert()
-            time.sleep(1)
-            QApplication.processEvents()
-            self.unpause()
-            time.sleep(1)
+            self.ctrl_solver.request(self.active_lenslets)
 
     def set_n_modes(self,n):
+        # Takes effect immediately: the factorization of the poke matrix
+        # is kept, so only the control matrix is reassembled.
         try:
-            self.poke.n_modes = n
+            self.poke.n_modes = self.poke.get_n_modes(n)
+            self.ctrl_solver.request(self.active_lenslets)
         except Exception as e:
             print e
 
@@ -187,50 +213,46 @@ class Loop(QObject):
     def get_condition_number(self):
         out = -1
         try:
-            out = self.poke.cutoff_cond
+            out = self.ctrl_solver.get().cutoff_cond
         except Exception as e:
             print e
         return out
             
-    def run_poke(self):
-        cmin = ccfg.poke_command_min
-        cmax = ccfg.poke_command_max
-        n_commands = ccfg.poke_n_command_steps
-        commands = np.linspace(cmin,cmax,n_commands)
+    def measure_slopes(self,command):
+        """Send command, wait for the mirror to settle, and return the
+        slopes (x, then y) sensed."""
+        self.mirror.set_command(command)
+        self.mirror.send()
+        time.sleep(self.mirror.settling_time)
+        self.sensor.sense()
+        sensor_mutex.lock()
+        slopes = np.hstack((self.sensor.x_slopes,self.sensor.y_slopes))
+        sensor_mutex.unlock()
+        return slopes
 
+    def run_poke(self):
         self.pause()
-        time.sleep(1)
-        
+
         n_lenslets = self.sensor.n_lenslets
         n_actuators = self.mirror.n_actuators
-        
-        x_mat = np.zeros((n_lenslets,n_actuators,n_commands))
-        y_mat = np.zeros((n_lenslets,n_actuators,n_commands))
-        
-        for k_actuator in range(n_actuators):
-            self.mirror.flatten()
-            for k_command in range(n_commands):
-                cur = commands[k_command]
-                print k_actuator,cur
-                self.mirror.set_actuator(k_actuator,cur)
-                QApplication.processEvents()
-                time.sleep(.01)
-                self.sensor.sense()
-                sensor_mutex.lock()
-                x_mat[:,k_actuator,k_command] = self.sensor.x_slopes
-                y_mat[:,k_actuator,k_command] = self.sensor.y_slopes
-                sensor_mutex.unlock()
+        acquisition = PokeAcquisition(n_actuators,2*n_lenslets)
+        self.poke_acquisition = acquisition
+
+        t0 = time.time()
+        if not acquisition.push_pull:
+            acquisition.set_flat_slopes(self.measure_slopes(self.mirror.flat))
+        for k in range(acquisition.n_measurements):
+            slopes = [self.measure_slopes(command) for command in acquisition.get_commands(k,self.mirror.flat)]
+            acquisition.add(k,*slopes)
+            if (k+1)%ccfg.poke_ui_update_interval==0:
                 self.finished.emit()
-        # print 'done'
+                QApplication.processEvents()
+        print 'Measured %d poke patterns (%d frames) in %0.1f s'%(acquisition.n_measurements,acquisition.n_frames,time.time()-t0)
         self.mirror.flatten()
-        
-        d_commands = np.mean(np.diff(commands))
-        d_x_mat = np.diff(x_mat,axis=2)
-        d_y_mat = np.diff(y_mat,axis=2)
 
-        x_response = np.mean(d_x_mat/d_commands,axis=2)
-        y_response = np.mean(d_y_mat/d_commands,axis=2)
-        poke = np.vstack((x_response,y_response))
+        poke = acquisition.get_poke()
+        # the offsets from the flat actually sent, after clipping
+        commands = acquisition.offsets
         ns = now_string()
         poke_fn = os.path.join(ccfg.poke_directory,'%s_poke.txt'%ns)
         command_fn = os.path.join(ccfg.poke_directory,'%s_currents.txt'%ns)
@@ -239,9 +261,7 @@ class Loop(QObject):
         np.savetxt(command_fn,commands)
         save_modes_chart(chart_fn,poke,commands,self.mirror.mask)
 
-        self.poke = Poke(poke)
-        
-        time.sleep(1)
+        self.set_poke(poke)
         self.unpause()
 
     def set_closed(self,val):
@@ -1,6 +1,5 @@
 import numpy as np
 import time
-import centroid
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -25,6 +24,7 @@ from search_boxes import SearchBoxes
 from reference_generator import ReferenceGenerator
 from ciao import config as ccfg
 from frame_timer import FrameTimer
+from telemetry import TelemetryLogger
 
 class MirrorController(object):
     def __init__(self):
@@ -117,6 +117,7 @@ class Mirror(QObject):
         #self.timer.timeout.connect(self.update)
         #self.timer.start(1.0/self.update_rate*1000.0)
         self.frame_timer = FrameTimer('Mirror',verbose=False)
+        self.telemetry = TelemetryLogger('mirror',[('command',(self.n_actuators,),np.float64)])
         self.logging = False
         self.paused = False
         
@@ -156,10 +157,11 @@ class Mirror(QObject):
         return self.controller.command
         
     def log(self):
-        outfn = os.path.join(ccfg.logging_directory,'mirror_%s.mat'%(now_string(True)))
-        d = {}
-        d['command'] = self.controller.command
-        sio.savemat(outfn,d)
+        self.telemetry.record(command=self.controller.command)
 
     def set_logging(self,val):
+        if val:
+            self.telemetry.start()
+        else:
+            self.telemetry.stop()
         self.logging = val
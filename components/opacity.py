@@ -0,0 +1,158 @@
+"""Simulated occluders for SimulatedCamera.
+
+An Occluder is a disc that dims the spots image by a fixed transmission
+factor, e.g. a floater in the vitreous, or, if large and intermittent, a
+blink. Each occluder drifts by a random walk (plus an optional constant
+velocity) every frame. OpacityModel applies any number of occluders to a
+frame. Only the pixels in each occluder's bounding box are touched, and
+the output frames and the per-occluder work arrays are allocated once and
+reused, so that the cost per frame is a copy of the image plus a few
+small operations per occluder.
+
+"""
+
+import numpy as np
+from ciao import config as ccfg
+
+class Occluder:
+
+    def __init__(self,x_px,y_px,radius_px=50,transmission=0.2,drift_px=0.5,
+                 vx_px=0.0,vy_px=0.0,period_frames=None,duration_frames=None):
+        """Create an occluder.
+
+        Args:
+
+          x_px, y_px (float): initial center of the occluder
+
+          radius_px (float): radius of the occluder
+
+          transmission (float): fraction of light passing through the
+            occluder
+
+          drift_px (float): standard deviation of the random step taken
+            by the center every frame
+
+          vx_px, vy_px (float): constant velocity of the center, in pixels
+            per frame
+
+          period_frames, duration_frames (int): if specified, the occluder
+            is only present for duration_frames out of every
+            period_frames frames, e.g. to simulate blinks; otherwise it is
+            always present
+        """
+        self.x_px = float(x_px)
+        self.y_px = float(y_px)
+        self.radius_px = float(radius_px)
+        self.transmission = float(transmission)
+        self.drift_px = float(drift_px)
+        self.vx_px = float(vx_px)
+        self.vy_px = float(vy_px)
+        self.period_frames = period_frames
+        self.duration_frames = duration_frames
+        if period_frames is not None:
+            self.phase = np.random.randint(period_frames)
+        else:
+            self.phase = 0
+        self.frame_count = 0
+
+        # offsets of the pixels in the bounding box of a disc centered on
+        # a pixel; the box is one pixel larger than the disc, so that it
+        # covers the disc at any subpixel position
+        r = int(np.ceil(self.radius_px))+1
+        offsets = np.arange(-r,r+1,dtype=np.float)
+        self.dx = offsets[np.newaxis,:]
+        self.dy = offsets[:,np.newaxis]
+        self.box_half_width = r
+        self.d2 = np.zeros((2*r+1,2*r+1))
+        self.inside = np.zeros((2*r+1,2*r+1),dtype=np.bool)
+        self.dimmed = np.zeros((2*r+1,2*r+1))
+
+    def is_present(self):
+        if self.period_frames is None:
+            return True
+        return (self.frame_count+self.phase)%self.period_frames<self.duration_frames
+
+    def step(self):
+        """Advance the occluder by one frame."""
+        self.x_px = self.x_px+self.vx_px+np.random.randn()*self.drift_px
+        self.y_px = self.y_px+self.vy_px+np.random.randn()*self.drift_px
+        self.frame_count+=1
+
+    def apply(self,im):
+        """Dim the pixels of im (in place) that lie within the occluder."""
+        if not self.is_present():
+            return
+        sy,sx = im.shape
+        r = self.box_half_width
+        cx = int(round(self.x_px))
+        cy = int(round(self.y_px))
+
+        # clip the bounding box to the image, and the work arrays to match
+        x1,x2 = max(cx-r,0),min(cx+r+1,sx)
+        y1,y2 = max(cy-r,0),min(cy+r+1,sy)
+        if x2<=x1 or y2<=y1:
+            return
+        bx1,by1 = x1-(cx-r),y1-(cy-r)
+        bx2,by2 = bx1+x2-x1,by1+y2-y1
+        d2 = self.d2[by1:by2,bx1:bx2]
+        inside = self.inside[by1:by2,bx1:bx2]
+        dimmed = self.dimmed[by1:by2,bx1:bx2]
+        region = im[y1:y2,x1:x2]
+
+        # squared distance from the (subpixel) center
+        np.add((self.dx[:,bx1:bx2]-(self.x_px-cx))**2,
+               (self.dy[by1:by2,:]-(self.y_px-cy))**2,out=d2)
+        np.less_equal(d2,self.radius_px**2,out=inside)
+        np.multiply(region,self.transmission,out=dimmed)
+        np.rint(dimmed,out=dimmed)
+        np.copyto(region,dimmed,where=inside,casting='unsafe')
+
+
+class OpacityModel:
+
+    def __init__(self,shape,occluders=None,n_buffers=2):
+        """Create an opacity model for images of the given (sy,sx) shape.
+
+        Args:
+
+          shape (tuple): the shape of the images
+
+          occluders (list): Occluder objects; by default, occluders are
+            created from ccfg.simulated_camera_occluders, at random
+            positions in the central half of the image
+
+          n_buffers (int): number of output frames, which are reused in
+            rotation; a frame returned by apply stays valid until
+            n_buffers further frames have been produced, which must be at
+            least as many as the consumer keeps (the Sensor keeps two)
+        """
+        self.shape = tuple(shape)
+        if occluders is None:
+            occluders = self.make_default_occluders()
+        self.occluders = occluders
+        self.n_buffers = n_buffers
+        self.buffers = None
+        self.buffer_index = 0
+
+    def make_default_occluders(self):
+        sy,sx = self.shape
+        occluders = []
+        for params in ccfg.simulated_camera_occluders:
+            x = np.random.rand()*sx//2+sx//4
+            y = np.random.rand()*sy//2+sy//4
+            occluders.append(Occluder(x,y,**params))
+        return occluders
+
+    def apply(self,im):
+        """Return a copy of im with all occluders applied, and advance
+        the occluders by one frame. im itself is not modified, so it may
+        be a read-only view."""
+        if self.buffers is None or self.buffers[0].dtype!=im.dtype:
+            self.buffers = [np.zeros(self.shape,dtype=im.dtype) for k in range(self.n_buffers)]
+        out = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index+1)%self.n_buffers
+        out[...] = im
+        for occluder in self.occluders:
+            occluder.apply(out)
+            occluder.step()
+        return out
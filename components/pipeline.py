@@ -0,0 +1,366 @@
+"""A headless real-time control pipeline.
+
+In the Qt application, Sensor.update and Loop.update trigger each other
+with queued signals across QThreads, and the Mirror sends its command on
+its own timer, so a new command may wait up to a timer period before it
+is sent. Pipeline runs the same work without Qt, as four stages, each on
+its own thread:
+
+  grab:     grab an image from the camera
+  centroid: compute slopes (and the wavefront, if enabled) with
+            Sensor.process
+  control:  compute the mirror command with Loop.compute_command
+  send:     send the command to the mirror as soon as it arrives
+
+The stages are connected by Handoffs, single slots which hold only the
+newest item: a stage that falls behind skips to the newest input instead
+of working through a queue of stale ones. Items are preallocated Packets,
+owned by one stage at a time; a packet displaced from a slot before it
+was taken goes straight back to its pool. The pools are deques, whose
+append and popleft are atomic, and the only lock is held by a Handoff for
+the duration of a reference swap.
+
+Every packet carries the time the image was grabbed and the time each
+stage finished with it, and the send stage records the latency of each
+stage (see get_latency).
+
+The UI does not touch the pipeline's buffers: at most every
+ccfg.pipeline_snapshot_interval_s, the control stage copies its frame and
+command into a Snapshot, which is published by a single reference
+assignment (see get_snapshot).
+
+"""
+
+import numpy as np
+import threading
+import time
+import copy
+from collections import deque
+from ciao import config as ccfg
+
+# indices into Packet.times
+GRAB = 0
+CENTROID = 1
+CONTROL = 2
+SEND = 3
+STAGE_NAMES = ['grab','centroid','control','send']
+
+class Handoff:
+
+    def __init__(self):
+        """A single slot, holding the newest item put into it."""
+        self.item = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.n_put = 0
+        self.n_dropped = 0
+
+    def put(self,item):
+        """Put item in the slot, and return the item it displaced, which
+        was never taken, or None."""
+        with self.lock:
+            displaced = self.item
+            self.item = item
+            self.n_put+=1
+            if displaced is not None:
+                self.n_dropped+=1
+            self.ready.set()
+        return displaced
+
+    def wake(self):
+        """Make a waiting take return, with None if the slot is empty."""
+        self.ready.set()
+
+    def take(self,timeout=None):
+        """Wait up to timeout seconds (by default, indefinitely) for an
+        item, and take it from the slot; return None if there was none.
+
+        In Python 2, Event.wait and Condition.wait with a timeout poll,
+        sleeping up to 50 ms between checks, which would add up to 50 ms
+        of latency to every item. So the stages wait without a timeout
+        and are woken (see wake) to stop; other threads in ciao which
+        must respond promptly (CtrlSolver, Acquisition) do the same."""
+        if not self.ready.wait(timeout):
+            return None
+        with self.lock:
+            item = self.item
+            self.item = None
+            self.ready.clear()
+        return item
+
+
+class Packet:
+
+    def __init__(self,data,pool):
+        """A preallocated buffer passed between stages. When released,
+        it returns to pool, along with its parent, if any (e.g. the image
+        a frame was computed from)."""
+        self.data = data
+        self.pool = pool
+        self.parent = None
+        self.metadata = None
+        self.times = np.zeros(len(STAGE_NAMES))
+
+    def release(self):
+        if self.parent is not None:
+            self.parent.release()
+            self.parent = None
+        self.pool.append(self)
+
+
+class Snapshot:
+
+    def __init__(self,frame,command,active_lenslets):
+        """Copies of a SensorFrame, the mirror command computed from it,
+        and the active lenslets, for display."""
+        self.frame = copy.deepcopy(frame)
+        self.command = command.copy()
+        self.active_lenslets = active_lenslets.copy()
+
+
+class Pipeline:
+
+    def __init__(self,loop,camera=None):
+        """Create a pipeline for loop's sensor and mirror, grabbing images
+        from camera, which defaults to the sensor's camera."""
+        self.loop = loop
+        self.sensor = loop.sensor
+        self.mirror = loop.mirror
+        if camera is None:
+            camera = self.sensor.cam
+        self.camera = camera
+
+        self.images = Handoff()
+        self.frames = Handoff()
+        self.commands = Handoff()
+
+        # Each stage holds at most one packet of its input and one of its
+        # output, and each slot one more. Frames hold on to their images
+        # until the control stage is done with them, so there may be two
+        # more images in use.
+        self.free_images = deque()
+        for k in range(5):
+            self.free_images.append(Packet(None,self.free_images))
+        self.free_frames = deque()
+        for k in range(3):
+            self.free_frames.append(Packet(self.sensor.make_frame(),self.free_frames))
+        self.free_commands = deque()
+        for k in range(3):
+            self.free_commands.append(Packet(np.zeros(self.mirror.n_actuators),self.free_commands))
+
+        # per-stage latency of the last latency_buffer_size commands sent:
+        # the time each stage finished minus the time the previous one did
+        self.latency_buffer_size = ccfg.pipeline_latency_buffer_size
+        self.latencies = np.zeros((self.latency_buffer_size,len(STAGE_NAMES)-1))
+        self.n_sent = 0
+
+        self.snapshot_interval = ccfg.pipeline_snapshot_interval_s
+        self.snapshot = None
+        self.snapshot_time = 0.0
+
+        self.n_errors = 0
+        self.error = None
+
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        # The pipeline replaces the Qt loop: stop the sensor's updates and
+        # the mirror's timed sends, which would compete with the stages.
+        self.sensor.pause()
+        self.mirror.pause()
+        self.loop.paused = True
+        self.running = True
+        self.threads = []
+        for target in [self.grab,self.centroid,self.control,self.send]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for handoff in [self.images,self.frames,self.commands]:
+            handoff.wake()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # return any packets left in the slots to their pools
+        for handoff in [self.images,self.frames,self.commands]:
+            packet = handoff.take(0)
+            if packet is not None:
+                packet.release()
+        self.loop.paused = False
+        self.sensor.unpause()
+        self.mirror.unpause()
+
+    def run_stopped(self,function,*args):
+        """Stop the pipeline, if it is running, call function with args
+        and restart it. For work which uses the sensor or mirror directly,
+        e.g. Loop.run_poke, and would otherwise compete with the stages."""
+        running = self.running
+        if running:
+            self.stop()
+        try:
+            return function(*args)
+        finally:
+            if running:
+                self.start()
+
+    def give(self,handoff,packet):
+        displaced = handoff.put(packet)
+        if displaced is not None:
+            displaced.release()
+
+    def get_free(self,pool,name):
+        """Take a packet from pool; every packet is accounted for by the
+        stages and slots, so an empty pool means one was not released."""
+        try:
+            return pool.popleft()
+        except IndexError:
+            raise RuntimeError('No free %s packet; one was not released.'%name)
+
+    def report(self,e,last_error):
+        """Count a stage's error and keep it, as Acquisition.run does, and
+        print it if it differs from the stage's last one; return its
+        repr, for the next call."""
+        self.n_errors+=1
+        self.error = e
+        if repr(e)!=last_error:
+            print e
+        return repr(e)
+
+    # Each stage catches its errors, releases the packets it holds and
+    # carries on with the next item. A packet's variable is set to None
+    # once it has been handed on, so it is never released twice.
+
+    def grab(self):
+        # After a failed grab, the next is tried after retry_delay, which
+        # doubles, up to 1 s, while grabs keep failing, as in
+        # Acquisition.run.
+        retry_delay = 0.0
+        last_error = None
+        while self.running:
+            packet = None
+            try:
+                # images are grabbed straight into the pipeline's buffers
+                packet = self.get_free(self.free_images,'image')
+                packet.data,packet.metadata = self.camera.grab_into(packet.data)
+                packet.times[GRAB] = packet.metadata.timestamp
+                self.give(self.images,packet)
+                retry_delay = 0.0
+                last_error = None
+            except Exception as e:
+                if packet is not None:
+                    packet.release()
+                last_error = self.report(e,last_error)
+                retry_delay = min(max(2*retry_delay,0.01),1.0)
+                time.sleep(retry_delay)
+
+    def centroid(self):
+        last_error = None
+        while self.running:
+            image_packet = self.images.take()
+            if image_packet is None:
+                continue
+            packet = None
+            try:
+                packet = self.get_free(self.free_frames,'frame')
+                if not self.sensor.process(image_packet.data,packet.data,image_packet.metadata):
+                    # read out with a previous region of interest
+                    packet.release()
+                    image_packet.release()
+                    continue
+                packet.parent = image_packet
+                image_packet = None
+                packet.times[:] = packet.parent.times
+                packet.times[CENTROID] = time.time()
+                self.sensor.frame_timer.tick()
+                self.give(self.frames,packet)
+                last_error = None
+            except Exception as e:
+                if packet is not None:
+                    # releases the image too, if it is the frame's parent
+                    packet.release()
+                if image_packet is not None:
+                    image_packet.release()
+                last_error = self.report(e,last_error)
+
+    def control(self):
+        command = self.mirror.get_command().copy()
+        last_error = None
+        while self.running:
+            frame_packet = self.frames.take()
+            if frame_packet is None:
+                continue
+            packet = None
+            try:
+                frame = frame_packet.data
+                if self.loop.closed and self.loop.has_poke():
+                    self.loop.compute_command(frame,command)
+                    packet = self.get_free(self.free_commands,'command')
+                    packet.data[:] = command
+                    packet.times[:] = frame_packet.times
+                    packet.times[CONTROL] = time.time()
+                    self.give(self.commands,packet)
+                    packet = None
+                else:
+                    # follow changes made elsewhere, e.g. flattening
+                    command[:] = self.mirror.get_command()
+                # snapshots are made after the command is handed off, so
+                # they don't delay it
+                t = time.time()
+                if t-self.snapshot_time>=self.snapshot_interval:
+                    self.snapshot = Snapshot(frame,command,self.loop.active_lenslets)
+                    self.snapshot_time = t
+                last_error = None
+            except Exception as e:
+                if packet is not None:
+                    packet.release()
+                last_error = self.report(e,last_error)
+            frame_packet.release()
+
+    def send(self):
+        last_error = None
+        while self.running:
+            packet = self.commands.take()
+            if packet is None:
+                continue
+            try:
+                self.mirror.set_command(packet.data)
+                self.mirror.send()
+                packet.times[SEND] = time.time()
+                if self.mirror.logging:
+                    self.mirror.log()
+                self.mirror.frame_timer.tick()
+                self.latencies[self.n_sent%self.latency_buffer_size,:] = np.diff(packet.times)
+                self.n_sent+=1
+                last_error = None
+            except Exception as e:
+                last_error = self.report(e,last_error)
+            packet.release()
+
+    def get_snapshot(self):
+        """Return the newest Snapshot, or None if there is none yet."""
+        return self.snapshot
+
+    def get_latency(self):
+        """Return a dict of (mean,max) latencies, in seconds, of the
+        centroid, control and send stages, each measured from the end of
+        the previous stage, and of the total from grab to send, over the
+        last commands sent."""
+        n = min(self.n_sent,self.latency_buffer_size)
+        out = {}
+        if n==0:
+            return out
+        latencies = self.latencies[:n].copy()
+        for k,name in enumerate(STAGE_NAMES[1:]):
+            out[name] = (latencies[:,k].mean(),latencies[:,k].max())
+        total = latencies.sum(axis=1)
+        out['total'] = (total.mean(),total.max())
+        return out
+
+    def print_latency(self):
+        latency = self.get_latency()
+        print ', '.join(['%s %0.2f/%0.2f ms'%(name,latency[name][0]*1000,latency[name][1]*1000)
+                         for name in STAGE_NAMES[1:]+['total'] if name in latency])
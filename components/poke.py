@@ -1,119 +1,349 @@
 from ciao import config as ccfg
 import numpy as np
 import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+
+    def __init__(self,max_bytes):
+        """A thread-safe dictionary which evicts its least recently used
+        entries when their total size exceeds max_bytes. The newest entry
+        is always kept."""
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,key):
+        with self.lock:
+            try:
+                value,n_bytes = self.entries.pop(key)
+            except KeyError as ke:
+                return None
+            # reinsert the entry, making it the most recently used
+            self.entries[key] = (value,n_bytes)
+        return value
+
+    def put(self,key,value,n_bytes):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value,n_bytes)
+            self.n_bytes+=n_bytes
+            while self.n_bytes>self.max_bytes and len(self.entries)>1:
+                old_key,(old_value,old_n_bytes) = self.entries.popitem(last=False)
+                self.n_bytes-=old_n_bytes
+
+
+def randomized_svd(A,n_modes,n_oversamples=10,n_iterations=2):
+    """Return (U,s,V) approximating the first n_modes singular triplets
+    of A, computed from a random projection of A onto n_modes+n_oversamples
+    dimensions, refined by n_iterations power iterations. A fixed seed is
+    used, so the result is reproducible."""
+    m,n = A.shape
+    l = min(n_modes+n_oversamples,n)
+    Q = np.dot(A,np.random.RandomState(0).randn(n,l))
+    for k in range(n_iterations):
+        Q,r = np.linalg.qr(Q)
+        Q = np.dot(A,np.dot(A.T,Q))
+    Q,r = np.linalg.qr(Q)
+    Ub,s,Vt = np.linalg.svd(np.dot(Q.T,A),full_matrices=False)
+    return np.dot(Q,Ub),s,Vt.T
+
 
 class Poke:
     def __init__(self,poke_matrix):
         self.poke = poke_matrix
         poke_rows = poke_matrix.shape[1]
         self.n_modes = min(ccfg.loop_n_control_modes,poke_rows)
-        
-        self.n_ctrl_stored = 0
-        self.ctrl_dict = {}
-        self.ctrl_key_list = []
+        self.method = ccfg.poke_inversion_method
+        self.tikhonov_lambda = ccfg.poke_tikhonov_lambda
+
+        # Control matrices are cached by lenslet mask and inversion
+        # parameters, and the factorizations (U,s,V) of the masked poke
+        # matrices by lenslet mask, so that changing the number of modes
+        # or the regularization only requires reassembling the control
+        # matrix. The least recently used entries are evicted when the
+        # total size of either cache exceeds ctrl_cache_max_mb. Both
+        # caches may be used by a CtrlSolver thread as well as the loop.
+        max_bytes = int(ccfg.ctrl_cache_max_mb*1024*1024)
+        self.ctrl_cache = LRUCache(max_bytes)
+        self.factor_cache = LRUCache(max_bytes)
+        self.metrics = {}
+
+        # The full poke matrix, with or without the mean subtracted, and
+        # its Gram matrix (poke.T poke), keyed by subtract_mean.
+        self.pokes = {}
+        self.grams = {}
+        self.get_poke()
         self.invert()
 
-    def mask_to_key(self,mask):
+    def mask_to_key(self,mask,subtract_mean=False):
+        # no mask is the same as a mask of all lenslets
         if mask is None:
-            return 'None'
-        else:
-            return '_'.join(['%d'%idx for idx in np.where(mask==0)[0]])+'_%d'%self.n_modes
-
-    def get_stored_ctrl(self,mask):
-        key = self.mask_to_key(mask)
-        try:
-            out = self.ctrl_dict[key]
-        except KeyError as ke:
-            out = None
-
-    def store_ctrl(self,mask,ctrl):
-        key = self.mask_to_key(mask)
-        if key in self.ctrl_dict.keys():
-            return
-        self.ctrl_dict[key] = ctrl
-        self.ctrl_key_list.append(key)
-        self.n_ctrl_stored+=1
-        #self.print_dict_info()
-        assert self.n_ctrl_stored==len(self.ctrl_dict.keys())
-        assert self.n_ctrl_stored==len(self.ctrl_key_list)
+            mask = np.ones(self.poke.shape[0]//2)
+        mask_key = np.packbits(np.asarray(mask)!=0).tostring()
+        return (mask_key,subtract_mean,self.method)
+
+    def get_n_modes(self,n_modes=None):
+        if n_modes is None:
+            n_modes = self.n_modes
+        return max(1,min(int(n_modes),self.poke.shape[1]))
+
+    def get_stored_ctrl(self,mask,subtract_mean=False,n_modes=None):
+        """Return the stored (ctrl,full_cond,cutoff_cond) for mask, or
+        None if it is not stored. n_modes defaults to self.n_modes, here
+        and in the methods below; it may be given explicitly by callers
+        on other threads, which must not depend on self.n_modes staying
+        unchanged between calls."""
+        key = self.mask_to_key(mask,subtract_mean)+(self.get_n_modes(n_modes),self.tikhonov_lambda)
+        return self.ctrl_cache.get(key)
+
+    def store_ctrl(self,mask,stored,subtract_mean=False,n_modes=None):
+        """Store (ctrl,full_cond,cutoff_cond) for mask."""
+        key = self.mask_to_key(mask,subtract_mean)+(self.get_n_modes(n_modes),self.tikhonov_lambda)
+        self.ctrl_cache.put(key,stored,stored[0].nbytes)
 
     def print_dict_info(self):
-        print 'N stored:',self.n_ctrl_stored
-        print 'Current dictionary:'
-        print self.ctrl_dict.keys()
-        print 'Current key list:'
-        print self.ctrl_key_list
+        print 'N stored:',len(self.ctrl_cache)
+        print 'MB stored: %0.1f'%(self.ctrl_cache.n_bytes/1024.0/1024.0)
+        print 'N factorizations stored:',len(self.factor_cache)
+        print 'MB factorizations stored: %0.1f'%(self.factor_cache.n_bytes/1024.0/1024.0)
         print
 
-    def trim_ctrl_dict(self):
-        if self.n_ctrl_stored<=ccfg.ctrl_dictionary_max_size:
-            return
-        else:
-            n_to_remove = self.n_ctrl_stored-ccfg.ctrl_dictionary_max_size
-            print 'Removing %d'%n_to_remove
-            for k in range(n_to_remove):
-                key = self.ctrl_key_list[k]
-                self.print_dict_info()
-                print 'Key to remove: %s'%key
-                del self.ctrl_dict[key]
-                self.n_ctrl_stored-=1
-                self.ctrl_key_list.remove(key)
-        
+    def get_poke(self,subtract_mean=False):
+        if subtract_mean not in self.pokes:
+            poke = self.poke.copy()
+            if subtract_mean:
+                # subtract mean influence across actuators from
+                # each actuator's influence
+                # transpose, broadcast, transpose back:
+                m_poke = np.mean(poke,axis=1)
+                poke = (poke.T - m_poke).T
+            self.pokes[subtract_mean] = poke
+            self.grams[subtract_mean] = np.dot(poke.T,poke)
+        return self.pokes[subtract_mean],self.grams[subtract_mean]
+
     def invert(self,subtract_mean=False,mask=None):
-        self.ctrl = self.get_stored_ctrl(mask)
-        if self.ctrl is not None:
-            return
-        
-        t0 = time.time()
+        stored = self.get_stored_ctrl(mask,subtract_mean)
+        if stored is None:
+            stored = self.compute_ctrl(mask,subtract_mean)
+            self.store_ctrl(mask,stored,subtract_mean)
+        self.ctrl,self.full_cond,self.cutoff_cond = stored
+
+    def get_factors(self,mask=None,subtract_mean=False,n_modes=None):
+        """Return (factors,cached), the factorization of the poke matrix
+        for the lenslets in mask and whether it was found in the cache.
+        factors is a dict with keys 'U', 's', 'V', 'n_valid' (the number
+        of leading modes that were computed accurately), and 'tolerance'
+        (the relative size below which singular values are not
+        resolved)."""
+        n_modes = self.get_n_modes(n_modes)
+        key = self.mask_to_key(mask,subtract_mean)
+        factors = self.factor_cache.get(key)
+        if factors is not None and factors['n_valid']>=n_modes:
+            return factors,True
 
-        poke = self.poke.copy()
+        poke,gram = self.get_poke(subtract_mean)
 
         #mask = np.round(np.random.rand(poke.shape[0]//2)).astype(np.int)
         if mask is not None:
             double_mask = np.hstack((mask,mask))
-            poke = poke[np.where(double_mask)[0],:]
+            rows = np.where(double_mask)[0]
+            removed = np.where(double_mask==0)[0]
+            # Dropping a few lenslets is a low rank downdate of the Gram
+            # matrix; if many are dropped, it's cheaper to recompute it.
+            if self.method=='gram' and len(removed)<len(rows):
+                removed_poke = poke[removed,:]
+                gram = gram-np.dot(removed_poke.T,removed_poke)
+                poke = poke[rows,:]
+            else:
+                poke = poke[rows,:]
+                gram = None
 
         double_n_lenslets,n_actuators = poke.shape
+        eps = np.finfo(np.float).eps
 
-        if subtract_mean:
-            # subtract mean influence across actuators from
-            # each actuator's influence
-            # transpose, broadcast, transpose back:
-            m_poke = np.mean(poke,axis=1)
-            poke = (poke.T - m_poke).T
-
-        U,s,V = np.linalg.svd(poke)
-        self.full_cond = (s[0]/s).max()
-        self.cutoff_cond = s[0]/s[self.n_modes-1]
-        
-        # zero upper modes
-        if self.n_modes<n_actuators:
-            s[self.n_modes:] = 0
-
-        term1 = V.T
-        term2 = np.zeros([n_actuators,double_n_lenslets])
-        term2[:n_actuators,:n_actuators] = np.linalg.pinv(np.diag(s))
-        term3 = U.T
-        ctrlmat = np.dot(np.dot(term1,term2),term3)
-        dt = time.time()-t0
-
-
-        sanity_check = False
-        if sanity_check:
-            # double check the explicit Moore-Penrose pseudoinverse
-            # above with LAPACK implementation (pinv)
-            cutoff_cond = s[n_modes]/s[0]
-            test = np.linalg.pinv(poke,cutoff_cond)
-            if np.allclose(test,ctrlmat):
-                print 'Pseudoinverse is correct.'
-                sys.exit()
-            else:
-                print 'Pseudoinverse is incorrect.'
-                sys.exit()
-            
-        self.ctrl = ctrlmat
-        print 'SVD %d modes %0.4e'%(self.n_modes,self.cutoff_cond)
-        self.store_ctrl(mask,self.ctrl)
-        self.trim_ctrl_dict()
-        self.print_dict_info()
-        print
+        if self.method=='gram':
+            # The singular values and right singular vectors of the poke
+            # matrix are the square roots of the eigenvalues and the
+            # eigenvectors of its (n_actuators x n_actuators) Gram
+            # matrix, which avoids an SVD of the (2*n_lenslets x
+            # n_actuators) poke matrix. Squaring the singular values
+            # limits their relative precision to about sqrt(eps).
+            if gram is None:
+                gram = np.dot(poke.T,poke)
+            evals,V = np.linalg.eigh(gram)
+            evals = evals[::-1]
+            V = V[:,::-1]
+            s = np.sqrt(np.maximum(evals,0.0))
+            tolerance = np.sqrt(eps)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                U = np.dot(poke,V)/s
+            U[:,s<=s[0]*tolerance] = 0.0
+            n_valid = n_actuators
+        elif self.method=='svd':
+            U,s,Vt = np.linalg.svd(poke,full_matrices=False)
+            V = Vt.T
+            tolerance = eps*max(poke.shape)
+            n_valid = n_actuators
+        elif self.method=='randomized':
+            n_valid = min(max(n_modes,ccfg.loop_n_control_modes),n_actuators)
+            U,s,V = randomized_svd(poke,n_valid,ccfg.poke_randomized_oversampling,
+                                   ccfg.poke_randomized_power_iterations)
+            tolerance = eps*max(poke.shape)
+        else:
+            raise ValueError('Unknown poke inversion method \'%s\'; choose \'gram\', \'svd\' or \'randomized\'.'%self.method)
+
+        factors = {'U':U,'s':s,'V':V,'n_valid':n_valid,'tolerance':tolerance}
+        self.factor_cache.put(key,factors,U.nbytes+V.nbytes+s.nbytes)
+        return factors,False
+
+    def compute_ctrl(self,mask=None,subtract_mean=False,n_modes=None):
+        """Compute the control matrix for the lenslets in mask, returning
+        (ctrl,full_cond,cutoff_cond). The factorization of the masked poke
+        matrix is cached, but the control matrix is not stored, so this
+        may be called from any thread. Timing and conditioning are
+        recorded in self.metrics."""
+        t0 = time.time()
+        n_modes = self.get_n_modes(n_modes)
+        factors,cached = self.get_factors(mask,subtract_mean,n_modes)
+        t1 = time.time()
+
+        U,s,V = factors['U'],factors['s'],factors['V']
+        n_modes = min(n_modes,len(s))
+        with np.errstate(divide='ignore'):
+            full_cond = (s[0]/s).max()
+            cutoff_cond = s[0]/s[n_modes-1]
+
+        # Invert only the first n_modes modes, and of those, only ones
+        # that are resolved. With Tikhonov regularization, 1/s becomes
+        # s/(s**2+lambda**2), which damps the weak modes smoothly.
+        sk = s[:n_modes]
+        resolved = sk>s[0]*factors['tolerance']
+        gains = np.zeros(n_modes)
+        gains[resolved] = sk[resolved]/(sk[resolved]**2+self.tikhonov_lambda**2)
+        ctrlmat = np.dot(V[:,:n_modes]*gains,U[:,:n_modes].T)
+        t2 = time.time()
+
+        self.metrics = {'method':self.method,
+                        'n_modes':n_modes,
+                        'n_rows':U.shape[0],
+                        'tikhonov_lambda':self.tikhonov_lambda,
+                        'factor_cached':cached,
+                        'factor_time_s':t1-t0,
+                        'assembly_time_s':t2-t1,
+                        'full_cond':full_cond,
+                        'cutoff_cond':cutoff_cond,
+                        'singular_values':s}
+        print 'Inverted %d modes (%s) %0.4e in %0.1f + %0.1f ms'%(n_modes,self.method,cutoff_cond,(t1-t0)*1000,(t2-t1)*1000)
+        return ctrlmat,full_cond,cutoff_cond
+
+
+class CtrlMatrix:
+
+    def __init__(self,mask,ctrl,full_cond,cutoff_cond,n_modes=None):
+        """A control matrix, with the lenslet mask and number of modes it
+        was computed for."""
+        self.mask = np.array(mask)!=0
+        self.n_modes = n_modes
+        self.lenslets = np.where(self.mask)[0]
+        self.ctrl = ctrl
+        self.full_cond = full_cond
+        self.cutoff_cond = cutoff_cond
+
+    def restrict(self,mask):
+        """Return (lenslets,ctrl) for applying this matrix when only the
+        lenslets in mask are valid: the indices of the lenslets that are
+        valid and were used to compute the matrix, and the columns of
+        the matrix for their x and y slopes."""
+        keep = (np.asarray(mask)!=0)[self.lenslets]
+        if keep.all():
+            return self.lenslets,self.ctrl
+        return self.lenslets[keep],self.ctrl[:,np.hstack((keep,keep))]
+
+
+class CtrlSolver:
+
+    def __init__(self,poke):
+        """Compute control matrices for new lenslet masks on a worker
+        thread.
+
+        request(mask) returns immediately; if the matrix is in the
+        Poke's cache it is used at once, and otherwise it is computed on
+        the worker thread. The number of modes is taken from the Poke
+        when the request is made, so a new mode count is applied by
+        requesting the current mask again; since the factorization of
+        the masked poke matrix is cached, this only reassembles the
+        matrix. If several requests are made while the worker is busy,
+        only the newest is computed. get returns the
+        newest finished CtrlMatrix, which is replaced by a single
+        reference assignment, so readers never see a partial update.
+        """
+        self.poke = poke
+        n_lenslets = poke.poke.shape[0]//2
+        self.current = CtrlMatrix(np.ones(n_lenslets),poke.ctrl,poke.full_cond,poke.cutoff_cond,poke.get_n_modes())
+
+        # requests are numbered, so that a slow computation finishing
+        # after a newer request has been served never replaces it
+        self.lock = threading.Lock()
+        self.pending = None
+        self.n_requested = 0
+        self.n_published = 0
+        self.n_coalesced = 0
+        self.request_ready = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        return self.current
+
+    def publish(self,request_id,mask,n_modes,stored):
+        with self.lock:
+            if request_id>self.n_published:
+                self.current = CtrlMatrix(mask,*stored,n_modes=n_modes)
+                self.n_published = request_id
+
+    def request(self,mask):
+        mask = np.array(mask)
+        n_modes = self.poke.get_n_modes()
+        with self.lock:
+            self.n_requested+=1
+            request_id = self.n_requested
+        stored = self.poke.get_stored_ctrl(mask,n_modes=n_modes)
+        if stored is not None:
+            self.publish(request_id,mask,n_modes,stored)
+            return
+        with self.lock:
+            if self.pending is not None:
+                self.n_coalesced+=1
+            self.pending = (request_id,mask,n_modes)
+            self.request_ready.set()
+
+    def run(self):
+        while self.running:
+            # untimed, as in pipeline.Handoff.take; stop sets the event
+            self.request_ready.wait()
+            with self.lock:
+                pending = self.pending
+                self.pending = None
+                self.request_ready.clear()
+            if pending is None:
+                continue
+            request_id,mask,n_modes = pending
+            stored = self.poke.get_stored_ctrl(mask,n_modes=n_modes)
+            if stored is None:
+                stored = self.poke.compute_ctrl(mask,n_modes=n_modes)
+                self.poke.store_ctrl(mask,stored,n_modes=n_modes)
+            self.publish(request_id,mask,n_modes,stored)
+
+    def stop(self):
+        self.running = False
+        self.request_ready.set()
+        self.thread.join()
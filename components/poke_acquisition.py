@@ -0,0 +1,178 @@
+"""Measurement of the poke (interaction) matrix with multi-actuator patterns.
+
+Instead of poking one actuator at a time, every measurement pokes all
+actuators at once, in a pattern of +1 and -1 (times the poke amplitude),
+and the poke matrix is recovered from all the measurements by a single
+least squares solve:
+
+    offsets * poke.T = differences
+
+where each row of offsets is the command sent, less the flat, and each
+row of differences the slopes measured, less those at the flat. The
+offsets are those actually sent, after clipping to the mirror's command
+range, so clipped patterns are solved for correctly.
+
+With push-pull measurements, each pattern is sent both added to and
+subtracted from the flat, and the difference of the two halves cancels
+the static aberration, its drift, and the even-order part of any actuator
+nonlinearity. Otherwise the flat is measured once and each pattern only
+pushed, which halves the number of frames.
+
+Since the spots move by the sum of every actuator's response, the
+per-actuator amplitude of multi-actuator patterns (poke_pattern_amplitude)
+is smaller than that of single-actuator pokes (poke_amplitude). With
+Hadamard patterns, the columns of the pattern matrix are orthogonal, so
+each actuator's response is averaged over every measurement rather than
+over the few in which it alone is poked; this more than makes up for the
+smaller amplitude. Random patterns work similarly, with any number of
+measurements. Single-actuator patterns reproduce the classic procedure.
+
+The number of frames is 2*n_patterns with push-pull and n_patterns+1
+without: for 97 actuators, 256 or 129 Hadamard patterns (the smallest
+Hadamard set has 128), or 194 or 98 with 97 random patterns.
+
+"""
+
+import numpy as np
+from scipy.linalg import hadamard
+from ciao import config as ccfg
+
+def make_patterns(n_actuators,kind='hadamard',n_patterns=None):
+    """Return an (n_patterns,n_actuators) array of +1/-1 (or 0) poke
+    patterns.
+
+    Args:
+
+      kind (str): 'hadamard' uses the columns 1..n_actuators of the
+        smallest Hadamard matrix with more than n_actuators rows (the
+        first column, all ones, would add piston to every pattern);
+        'random' uses random signs; 'single' pokes one actuator per
+        pattern
+
+      n_patterns (int): number of random patterns; defaults to
+        n_actuators, the fewest that can determine the matrix. Ignored
+        for the other kinds.
+    """
+    kind = kind.lower()
+    if kind=='hadamard':
+        order = 2**int(np.ceil(np.log2(n_actuators+1)))
+        return hadamard(order)[:,1:n_actuators+1].astype(np.float)
+    elif kind=='random':
+        if n_patterns is None:
+            n_patterns = n_actuators
+        return np.sign(np.random.rand(n_patterns,n_actuators)-0.5)
+    elif kind=='single':
+        return np.eye(n_actuators)
+    else:
+        raise ValueError('Unknown poke pattern \'%s\'; choose \'hadamard\', \'random\' or \'single\'.'%kind)
+
+
+class PokeAcquisition:
+
+    def __init__(self,n_actuators,n_slopes,kind=None,amplitude=None,n_patterns=None,n_repeats=None,push_pull=None):
+        """Create a poke acquisition for n_actuators actuators and
+        n_slopes slopes (x slopes followed by y slopes).
+
+        Args:
+
+          kind (str): the pattern kind; see make_patterns. Defaults to
+            ccfg.poke_pattern.
+
+          amplitude (float): the command added to (and, with push-pull,
+            subtracted from) the flat for each actuator; defaults to
+            ccfg.poke_amplitude for single-actuator patterns and
+            ccfg.poke_pattern_amplitude for the others
+
+          n_patterns (int): the number of random patterns; defaults to
+            ccfg.poke_n_patterns
+
+          n_repeats (int): the number of times each pattern is measured;
+            defaults to ccfg.poke_n_repeats
+
+          push_pull (bool): measure each pattern pushed and pulled, rather
+            than measuring the flat once (see set_flat_slopes) and each
+            pattern only pushed; defaults to ccfg.poke_push_pull
+        """
+        if kind is None:
+            kind = ccfg.poke_pattern
+        if amplitude is None:
+            if kind.lower()=='single':
+                amplitude = ccfg.poke_amplitude
+            else:
+                amplitude = ccfg.poke_pattern_amplitude
+        if n_patterns is None:
+            n_patterns = ccfg.poke_n_patterns
+        if n_repeats is None:
+            n_repeats = ccfg.poke_n_repeats
+        if push_pull is None:
+            push_pull = ccfg.poke_push_pull
+
+        self.n_actuators = n_actuators
+        self.n_slopes = n_slopes
+        self.amplitude = float(amplitude)
+        self.push_pull = push_pull
+        self.command_min = ccfg.mirror_command_min
+        self.command_max = ccfg.mirror_command_max
+        patterns = make_patterns(n_actuators,kind,n_patterns)
+        self.patterns = np.tile(patterns,(n_repeats,1))
+        self.n_measurements = len(self.patterns)
+        if push_pull:
+            self.n_frames = 2*self.n_measurements
+        else:
+            self.n_frames = self.n_measurements+1
+
+        # the offsets from the flat sent for each pattern, after
+        # clipping, and the slopes they caused, less those at the flat
+        self.offsets = np.zeros((self.n_measurements,n_actuators))
+        self.differences = np.zeros((self.n_measurements,n_slopes))
+        self.flat_slopes = None
+        self.n_measured = 0
+
+    def set_flat_slopes(self,slopes):
+        """Record the slopes measured at the flat, which, without
+        push-pull, must be done before any pattern is added."""
+        self.flat_slopes = slopes.copy()
+
+    def get_commands(self,index,flat):
+        """Return the commands for the pattern index: (push,pull) with
+        push-pull, else (push,). The commands are clipped to the mirror's
+        range, and the offsets actually sent recorded for the solve."""
+        offset = self.amplitude*self.patterns[index]
+        push = np.clip(flat+offset,self.command_min,self.command_max)
+        if self.push_pull:
+            pull = np.clip(flat-offset,self.command_min,self.command_max)
+            self.offsets[index] = (push-pull)/2.0
+            return push,pull
+        self.offsets[index] = push-flat
+        return (push,)
+
+    def add(self,index,push_slopes,pull_slopes=None):
+        """Record the slopes measured for the commands of the pattern
+        index (see get_commands). Patterns must be added in order."""
+        assert index==self.n_measured
+        if self.push_pull:
+            np.subtract(push_slopes,pull_slopes,out=self.differences[index])
+            self.differences[index]/=2.0
+        else:
+            np.subtract(push_slopes,self.flat_slopes,out=self.differences[index])
+        self.n_measured+=1
+
+    def is_complete(self):
+        return self.n_measured==self.n_measurements
+
+    def get_rank(self):
+        """Return the number of independent actuator combinations
+        measured so far."""
+        if self.n_measured==0:
+            return 0
+        return np.linalg.matrix_rank(self.offsets[:self.n_measured])
+
+    def get_poke(self):
+        """Return the (n_slopes,n_actuators) poke matrix estimated from
+        the measurements so far; until they span all actuators, this is
+        the minimum norm solution."""
+        n = self.n_measured
+        if n==0:
+            return np.zeros((self.n_slopes,self.n_actuators))
+        solution = np.linalg.lstsq(self.offsets[:n],self.differences[:n],rcond=None)[0]
+        return solution.T
@@ -0,0 +1,190 @@
+"""Selection of the wavefront reconstructor, and a zonal reconstructor.
+
+The modal Reconstructor (see zernike.py) fits the first n_zernike_terms
+Zernike terms to the slopes with a dense pseudoinverse. ZonalReconstructor
+instead solves for the phase at every lenslet directly, using the
+Southwell geometry: for each pair of neighboring lenslets in the
+reference mask, the phase difference divided by the lenslet pitch equals
+the mean of their slopes. The resulting sparse least squares problem is
+factorized once, so each frame costs a sparse matrix-vector product and
+two sparse triangular solves, and the reconstructed map has one phase
+value per lenslet. Zernike coefficients are optionally computed by
+projecting the phase map onto the Zernike basis.
+
+The reconstructor is chosen by ccfg.reconstructor_type, 'modal' or
+'zonal'.
+
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sparse_linalg
+from ciao import config as ccfg
+from zernike import Reconstructor,ZernikeBasis
+
+def get_reconstructor(x,y,mask,kind=None):
+    if kind is None:
+        kind = ccfg.reconstructor_type
+    kind = kind.lower()
+    if kind=='modal':
+        return Reconstructor(x,y,mask)
+    elif kind=='zonal':
+        return ZonalReconstructor(x,y,mask)
+    else:
+        raise ValueError('Unknown reconstructor type \'%s\'; choose \'modal\' or \'zonal\'.'%kind)
+
+def make_southwell_geometry(mask):
+    """Return (D,S), the sparse Southwell difference and slope averaging
+    matrices for the lenslets in mask.
+
+    Lenslets are numbered in row-major order of mask. For each pair of
+    horizontally or vertically adjacent lenslets, D has a row giving the
+    difference of their phases, and S a row giving the mean of their x
+    (or y) slopes, in a slope vector of x slopes followed by y slopes.
+    """
+    my,mx = mask.shape
+    index = -np.ones(mask.shape,dtype=np.int)
+    points = np.where(mask)
+    n_points = len(points[0])
+    index[points] = np.arange(n_points)
+
+    # pairs of neighbors: (first,second) indices, and the slope offset
+    # (0 for x, n_points for y) of the slopes they share
+    x_pairs = (index[:,:-1],index[:,1:])
+    y_pairs = (index[:-1,:],index[1:,:])
+    firsts = []
+    seconds = []
+    offsets = []
+    for (first,second),offset in [(x_pairs,0),(y_pairs,n_points)]:
+        valid = (first>=0)&(second>=0)
+        firsts.append(first[valid])
+        seconds.append(second[valid])
+        offsets.append(np.ones(valid.sum(),dtype=np.int)*offset)
+    firsts = np.concatenate(firsts)
+    seconds = np.concatenate(seconds)
+    offsets = np.concatenate(offsets)
+    n_pairs = len(firsts)
+
+    rows = np.concatenate((np.arange(n_pairs),np.arange(n_pairs)))
+    D = sparse.csr_matrix((np.concatenate((-np.ones(n_pairs),np.ones(n_pairs))),
+                           (rows,np.concatenate((firsts,seconds)))),
+                          shape=(n_pairs,n_points))
+    S = sparse.csr_matrix((np.ones(2*n_pairs)*0.5,
+                           (rows,np.concatenate((firsts+offsets,seconds+offsets)))),
+                          shape=(n_pairs,2*n_points))
+    return D,S
+
+
+class ZonalReconstructor(Reconstructor):
+
+    def __init__(self,x,y,mask,regularize=False,use_cache=None,project_zernikes=None):
+        """Create a zonal reconstructor.
+
+        Args:
+
+          project_zernikes (bool): compute Zernike coefficients from the
+            phase map; defaults to ccfg.zonal_project_zernikes. If False,
+            the coefficients are left at zero, and the dense modal
+            matrices, which cost n_lenslets*n_zernike_terms to build and
+            store, are not built at all.
+        """
+        if project_zernikes is None:
+            project_zernikes = ccfg.zonal_project_zernikes
+        self.project_zernikes = project_zernikes
+        if project_zernikes:
+            # the modal matrices (built or loaded from the cache) provide
+            # the Zernike basis for the projection
+            Reconstructor.__init__(self,x,y,mask,regularize,use_cache)
+            # least squares projection of the phase onto the Zernike basis
+            self.projection_matrix = np.linalg.pinv(self.scaled_wavefront_matrix)
+        else:
+            self.pixel_size = ccfg.pixel_size_m
+            self.pupil_size = ccfg.beam_diameter_m
+            self.N = ccfg.n_zernike_terms
+            self.regularize = regularize
+            self.mask = mask
+            self.mask_index = np.flatnonzero(self.mask)
+            self.wavefront = np.zeros(self.mask.shape)
+            self.slopes = np.zeros(2*len(x))
+            self.coefs = np.zeros(self.N)
+            self.make_defocus(x,y)
+        self.pitch = ccfg.lenslet_pitch_m
+
+        # Solve the normal equations (D.T D) phi = pitch D.T S s. D.T D
+        # is singular, since D does not see piston (in each connected
+        # part of the mask); a small multiple of the identity makes it
+        # invertible without changing the solution, because D.T S s has
+        # no piston component.
+        D,S = make_southwell_geometry(mask)
+        n_points = D.shape[1]
+        DtD = (D.T*D).tocsc()
+        epsilon = 1e-9*DtD.diagonal().max()
+        self.factor = sparse_linalg.splu(DtD+epsilon*sparse.identity(n_points,format='csc'))
+        self.rhs_matrix = (D.T*S).tocsr()*self.pitch
+        self.phase = np.zeros(n_points)
+
+    def make_defocus(self,x,y):
+        # the defocus vectors used by Sensor.set_defocus, as computed by
+        # Reconstructor.make_matrices, but evaluating only the terms up
+        # to defocus
+        if self.N>4:
+            basis = ZernikeBasis(*self.get_unit_pupil_coordinates(x,y))
+            self.defocus_h = basis.get(5,kind='h')[4]
+            self.defocus_dx = basis.get(5,kind='dx')[4]
+            self.defocus_dy = basis.get(5,kind='dy')[4]
+
+    def solve(self,slopes):
+        """Return the phase (one value per lenslet, in meters, with zero
+        mean) for slopes, either a vector of x slopes followed by y
+        slopes, or a (2*n_lenslets,n_frames) array of such vectors."""
+        phase = self.factor.solve(self.rhs_matrix.dot(slopes))
+        phase-=phase.mean(axis=0)
+        return phase
+
+    def get_wavefront(self,xslopes,yslopes,coefs_out=None,wavefront_out=None,compute_map=True):
+        """Reconstruct the wavefront from x and y slopes. The arguments
+        and return values are the same as Reconstructor.get_wavefront;
+        compute_map only skips writing the map, since the error is
+        computed from the phase."""
+        if coefs_out is None:
+            coefs_out = self.coefs
+        if wavefront_out is None:
+            wavefront_out = self.wavefront
+
+        n_lenslets = len(xslopes)
+        self.slopes[:n_lenslets] = xslopes
+        self.slopes[n_lenslets:2*n_lenslets] = yslopes
+
+        self.phase[:] = self.solve(self.slopes[:2*n_lenslets])
+        if self.project_zernikes:
+            np.dot(self.projection_matrix,self.phase,out=coefs_out)
+        error = self.phase.std()
+        if compute_map:
+            np.put(wavefront_out,self.mask_index,self.phase)
+        return coefs_out,wavefront_out,error
+
+    def get_wavefronts(self,x_slopes,y_slopes,chunk_size=None,return_maps=False):
+        """Reconstruct a time series of slopes in chunks; see
+        Reconstructor.get_wavefronts. The maps, if requested, are
+        returned as an (n_frames,sy,sx) array, since computing them is no
+        more expensive than computing the errors."""
+        if chunk_size is None:
+            chunk_size = ccfg.reconstruction_chunk_size
+        n_frames,n_lenslets = x_slopes.shape
+        coefs = np.zeros((n_frames,self.N))
+        errors = np.zeros(n_frames)
+        if return_maps:
+            maps = np.zeros((n_frames,self.mask.size))
+        for start in range(0,n_frames,chunk_size):
+            end = min(start+chunk_size,n_frames)
+            slopes = np.hstack((np.asarray(x_slopes[start:end],dtype=np.float),
+                                np.asarray(y_slopes[start:end],dtype=np.float))).T
+            phase = self.solve(slopes)
+            if self.project_zernikes:
+                coefs[start:end] = np.dot(self.projection_matrix,phase).T
+            errors[start:end] = phase.std(axis=0)
+            if return_maps:
+                maps[start:end,self.mask_index] = phase.T
+        if return_maps:
+            return coefs,errors,maps.reshape((n_frames,)+self.mask.shape)
+        return coefs,errors
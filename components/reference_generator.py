@@ -3,23 +3,24 @@ from ciao import config as ccfg
 import os,sys
 from tools import now_string
 
+def get_lenslet_grid(mask,x_offset=0.0,y_offset=0.0):
+    """Return an (n_lenslets,2) array of the nominal (x,y) coordinates, in
+    pixels, of the centers of the lenslets in mask, in row-major order."""
+    stride = ccfg.lenslet_pitch_m/ccfg.pixel_size_m
+    my,mx = mask.shape
+    xvec = np.arange(stride/2.0,mx*stride,stride)+x_offset
+    yvec = np.arange(stride/2.0,my*stride,stride)+y_offset
+    ref_xy = []
+    for y in range(my):
+        for x in range(mx):
+            if mask[y,x]:
+                ref_xy.append((xvec[x],yvec[y]))
+    return np.array(ref_xy)
+
 class ReferenceGenerator:
     def __init__(self,camera,mask,x_offset=0.0,y_offset=0.0,spot_half_width=5,window_spots=False):
         self.cam = camera
-        sensor_x = ccfg.image_width_px
-        sensor_y = ccfg.image_height_px
-        lenslet_pitch = ccfg.lenslet_pitch_m
-        pixel_size = ccfg.pixel_size_m
-        stride = lenslet_pitch/pixel_size
-        my,mx = mask.shape
-        xvec = np.arange(stride/2.0,mx*stride,stride)+x_offset
-        yvec = np.arange(stride/2.0,my*stride,stride)+y_offset
-        ref_xy = []
-        for y in range(my):
-            for x in range(mx):
-                if mask[y,x]:
-                    ref_xy.append((xvec[x],yvec[y]))
-        self.xy = np.array(ref_xy)
+        self.xy = get_lenslet_grid(mask,x_offset,y_offset)
         self.x_ref = self.xy[:,0]
         self.y_ref = self.xy[:,1]
         
@@ -20,36 +20,137 @@ class SearchBoxes(QObject):
         if not self.in_bounds(self.x1,self.x2,self.y1,self.y2):
             sys.exit('Search boxes extend beyond image edges. x %d %d, y %d, %d.'%
                      (self.x1.min(),self.x2.max(),self.y1.min(),self.y2.max()))
+        self.index_tables = None
 
     def resize(self,new_half_width):
-        x1 = np.round(self.x - self.half_width).astype(np.int16)
-        x2 = np.round(self.x + self.half_width).astype(np.int16)
-        y1 = np.round(self.y - self.half_width).astype(np.int16)
-        y2 = np.round(self.y + self.half_width).astype(np.int16)
-        
+        x1 = np.round(self.x - new_half_width).astype(np.int16)
+        x2 = np.round(self.x + new_half_width).astype(np.int16)
+        y1 = np.round(self.y - new_half_width).astype(np.int16)
+        y2 = np.round(self.y + new_half_width).astype(np.int16)
+
         # Check to make sure none of the search boxes are out of bounds:
         if self.in_bounds(x1,x2,y1,y2):
             self.half_width = new_half_width
-            self.x1 = x1
-            self.x2 = x2
-            self.y1 = y1
-            self.y2 = y2
+            self.set_edges(x1,x2,y1,y2)
 
     def move(self,x,y):
         self.x = x
         self.y = y
-        self.x1 = np.round(self.x - self.half_width).astype(np.int16)
-        self.x2 = np.round(self.x + self.half_width).astype(np.int16)
-        self.y1 = np.round(self.y - self.half_width).astype(np.int16)
-        self.y2 = np.round(self.y + self.half_width).astype(np.int16)
-        if not self.in_bounds(self.x1,self.x2,self.y1,self.y2):
+        x1 = np.round(self.x - self.half_width).astype(np.int16)
+        x2 = np.round(self.x + self.half_width).astype(np.int16)
+        y1 = np.round(self.y - self.half_width).astype(np.int16)
+        y2 = np.round(self.y + self.half_width).astype(np.int16)
+        if not self.in_bounds(x1,x2,y1,y2):
             sys.exit('Search boxes extend beyond image edges. x %d %d, y %d, %d.'%
-                     (self.x1.min(),self.x2.max(),self.y1.min(),self.y2.max()))
+                     (x1.min(),x2.max(),y1.min(),y2.max()))
+        self.set_edges(x1,x2,y1,y2)
+
+    def set_edges(self,x1,x2,y1,y2):
+        # The index tables depend only on the (integer) box edges, so
+        # they only need to be rebuilt if an edge has actually moved.
+        changed = not (np.array_equal(x1,self.x1) and np.array_equal(x2,self.x2) and
+                       np.array_equal(y1,self.y1) and np.array_equal(y2,self.y2))
+        self.x1 = x1
+        self.x2 = x2
+        self.y1 = y1
+        self.y2 = y2
+        if changed:
+            self.index_tables = None
 
     def in_bounds(self,x1,x2,y1,y2):
         return (x1.min()>=0 and x2.max()<=self.xmax and
                 y1.min()>=0 and y2.max()<=self.ymax)
 
+    def get_roi(self,margin=0):
+        """Return the bounding box (x,y,width,height) of all the search
+        boxes, grown by margin pixels on every side and clipped to the
+        image."""
+        x1 = max(int(self.x1.min())-margin,0)
+        y1 = max(int(self.y1.min())-margin,0)
+        x2 = min(int(self.x2.max())+margin,self.xmax)
+        y2 = min(int(self.y2.max())+margin,self.ymax)
+        return x1,y1,x2-x1+1,y2-y1+1
+
+    def in_roi(self,roi):
+        """Return True if all the search boxes lie within roi, an
+        (x,y,width,height) region of the image."""
+        x,y,width,height = roi
+        return (self.x1.min()>=x and self.x2.max()<x+width and
+                self.y1.min()>=y and self.y2.max()<y+height)
+
+    def get_index_tables(self,image_width=None,x_offset=0,y_offset=0,image_height=None):
+        """Return cached lookup tables for gathering search box pixels.
+
+        The tables are built on first use and reused until move or
+        resize changes the box edges. All boxes must be the same size,
+        which is the case whenever half_width is an integer.
+
+        Args:
+
+          image_width (int): width of the images the tables will index,
+            in pixels; defaults to ccfg.image_width_px.
+
+          x_offset, y_offset (int): the position of those images in the
+            full frame, if they are a region of interest (see get_roi).
+            The pixel indices are into the region, but the coordinates
+            in x_grid and y_grid remain full-frame coordinates.
+
+          image_height (int): height of the images, in pixels; defaults
+            to ccfg.image_height_px. A ValueError is raised if any box
+            extends beyond the images, rather than indexing pixels
+            wrapped around from other rows.
+
+        Returns:
+
+          dict: with keys
+            'pixel_index': (n, height*width) indices of every pixel in each
+              box, into the flattened image, in row-major order
+            'edge_index': indices of each box's edge pixels (top row,
+              bottom row, then left and right columns), used to estimate
+              the background
+            'x_grid', 'y_grid': (n, height*width) x and y coordinates of the
+              pixels in pixel_index
+            'x1', 'y1': the left and top edges of the boxes, in the
+              coordinates of the images indexed (i.e. less the offsets)
+            'height', 'width': the size of the boxes
+        """
+        if image_width is None:
+            image_width = ccfg.image_width_px
+        if image_height is None:
+            image_height = ccfg.image_height_px
+        key = (image_width,x_offset,y_offset,image_height)
+        if self.index_tables is not None and self.index_tables['key']==key:
+            return self.index_tables
+
+        heights = self.y2.astype(np.intp)-self.y1+1
+        widths = self.x2.astype(np.intp)-self.x1+1
+        if np.any(heights!=heights[0]) or np.any(widths!=widths[0]):
+            raise ValueError('Search boxes are not all the same size; index tables require a fixed box size.')
+        height,width = heights[0],widths[0]
+
+        x1 = self.x1.astype(np.intp)-x_offset
+        y1 = self.y1.astype(np.intp)-y_offset
+        if x1.min()<0 or y1.min()<0 or x1.max()+width>image_width or y1.max()+height>image_height:
+            raise ValueError('Search boxes extend beyond the %dx%d image at (%d,%d).'%(image_width,image_height,x_offset,y_offset))
+
+        y_grid = self.y1.astype(np.intp)[:,np.newaxis,np.newaxis]+np.arange(height)[:,np.newaxis]
+        x_grid = self.x1.astype(np.intp)[:,np.newaxis,np.newaxis]+np.arange(width)
+        y_grid,x_grid = np.broadcast_arrays(y_grid,x_grid)
+        pixel_index = (y_grid-y_offset)*image_width+(x_grid-x_offset)
+        edge_index = np.concatenate((pixel_index[:,0,:],pixel_index[:,-1,:],
+                                     pixel_index[:,1:-1,0],pixel_index[:,1:-1,-1]),axis=1)
+
+        self.index_tables = {'pixel_index':pixel_index.reshape(self.n,-1),
+                             'edge_index':edge_index,
+                             'x_grid':x_grid.reshape(self.n,-1).astype(np.float),
+                             'y_grid':y_grid.reshape(self.n,-1).astype(np.float),
+                             'x1':x1,
+                             'y1':y1,
+                             'height':height,
+                             'width':width,
+                             'key':key}
+        return self.index_tables
+
     def get_index(self,x,y):
         d = np.sqrt((self.x-x)**2+(self.y-y)**2)
         return np.argmin(d)
@@ -62,4 +163,4 @@ class SearchBoxes(QObject):
         sb = SearchBoxes(x,y,self.half_width)
         return sb
 
-        
+
@@ -1,6 +1,6 @@
 import numpy as np
 import time
-import centroid
+import centroiding
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -17,6 +17,7 @@ import datetime
 from tools import error_message, now_string, prepend, colortable, get_ram, get_process
 import copy
 from zernike import Reconstructor
+from reconstructors import get_reconstructor
 import cProfile
 import scipy.io as sio
 from poke_analysis import save_modes_chart
@@ -25,10 +26,66 @@ from search_boxes import SearchBoxes
 from reference_generator import ReferenceGenerator
 from ciao import config as ccfg
 from frame_timer import FrameTimer
+from telemetry import TelemetryLogger, ImageCapture
+
+def frame_property(name):
+    # expose an attribute of the front frame as a read-only attribute
+    # of the sensor
+    return property(lambda self: getattr(self.frame,name))
+
+
+class SensorFrame:
+    """A complete set of sensor outputs for one camera frame.
+
+    The arrays are allocated once and overwritten in place by
+    Sensor.sense. The Sensor keeps two frames and swaps them when a
+    frame is complete, so a frame obtained from Sensor.get_frame is
+    consistent and will not be modified until the sensor has completed
+    one more frame.
+    """
+    def __init__(self,n_lenslets,n_zernike_terms,mask_shape):
+        self.frame_id = -1
+        self.timestamp = 0.0
+        self.image = None
+        # the camera's FrameMetadata for image
+        self.metadata = None
+        # background-subtracted image, if Sensor.processed_image is set
+        self.processed_image = None
+        # the region of the sensor in image, as (x,y,width,height)
+        self.roi = None
+        self.x_slopes = np.zeros(n_lenslets)
+        self.y_slopes = np.zeros(n_lenslets)
+        self.x_centroids = np.zeros(n_lenslets)
+        self.y_centroids = np.zeros(n_lenslets)
+        self.box_maxes = np.zeros(n_lenslets)
+        self.box_mins = np.zeros(n_lenslets)
+        self.box_means = np.zeros(n_lenslets)
+        self.box_backgrounds = np.zeros(n_lenslets)
+        self.error = 0.0
+        self.tip = 0.0
+        self.tilt = 0.0
+        self.zernikes = np.zeros(n_zernike_terms)
+        self.wavefront = np.zeros(mask_shape)
+
 
 class Sensor(QObject):
 
     finished = pyqtSignal()
+
+    image = frame_property('image')
+    x_slopes = frame_property('x_slopes')
+    y_slopes = frame_property('y_slopes')
+    x_centroids = frame_property('x_centroids')
+    y_centroids = frame_property('y_centroids')
+    box_maxes = frame_property('box_maxes')
+    box_mins = frame_property('box_mins')
+    box_means = frame_property('box_means')
+    box_backgrounds = frame_property('box_backgrounds')
+    error = frame_property('error')
+    tip = frame_property('tip')
+    tilt = frame_property('tilt')
+    zernikes = frame_property('zernikes')
+    wavefront = frame_property('wavefront')
     
     def __init__(self,camera):
         super(Sensor,self).__init__()
@@ -42,16 +99,20 @@ class Sensor(QObject):
         self.background_correction = ccfg.background_correction
         self.centroiding_iterations = ccfg.centroiding_iterations
         self.iterative_centroiding_step = ccfg.iterative_centroiding_step
+        self.centroiding_num_threads = ccfg.centroiding_num_threads
+        self.centroider = centroiding.get_backend(ccfg.centroiding_backend)
         self.filter_lenslets = ccfg.sensor_filter_lenslets
         self.estimate_background = ccfg.estimate_background
         self.reconstruct_wavefront = ccfg.sensor_reconstruct_wavefront
+        self.wavefront_map = ccfg.sensor_wavefront_map
         self.remove_tip_tilt = ccfg.sensor_remove_tip_tilt
-        try:
-            # check to see if the camera object produced its own
-            # search boxes, and if not, use reference coordinates
-            self.search_boxes = camera.search_boxes
-            self.mask = camera.lenslet_mask
-        except Exception as e:
+        self.processed_image = ccfg.sensor_processed_image
+        # use the camera's own search boxes, if it makes its own images
+        # (e.g. SyntheticCamera), or else the reference coordinates
+        layout = camera.get_search_boxes()
+        if layout is not None:
+            self.search_boxes,self.mask = layout
+        else:
             xy = np.loadtxt(ccfg.reference_coordinates_filename)
             self.search_boxes = SearchBoxes(xy[:,0],xy[:,1],ccfg.search_box_half_width)
             self.mask = np.loadtxt(ccfg.reference_mask_filename)
@@ -64,33 +125,64 @@ class Sensor(QObject):
         
         self.n_lenslets = self.search_boxes.n
         n_lenslets = self.n_lenslets
-        self.image = np.zeros((ccfg.image_height_px,ccfg.image_width_px))
-        self.x_slopes = np.zeros(n_lenslets)
-        self.y_slopes = np.zeros(n_lenslets)
-        self.x_centroids = np.zeros(n_lenslets)
-        self.y_centroids = np.zeros(n_lenslets)
-        self.box_maxes = np.zeros(n_lenslets)
-        self.box_mins = np.zeros(n_lenslets)
-        self.box_means = np.zeros(n_lenslets)
-        self.box_backgrounds = np.zeros(n_lenslets)
-        self.error = 0.0
-        self.tip = 0.0
-        self.tilt = 0.0
-        self.zernikes = None
-        self.wavefront = None
 
         self.cam = camera
+
+        # The region of the sensor read out by the camera, as
+        # (x,y,width,height). Images are centroided in the region's
+        # coordinates, and the centroids shifted back into full-frame
+        # coordinates, so the reference coordinates remain valid.
+        self.roi = tuple(camera.get_roi())
+        self.roi_margin = ccfg.sensor_roi_margin_px
+        self.roi_x = np.zeros(n_lenslets)
+        self.roi_y = np.zeros(n_lenslets)
+        # The region is changed between frames, by the thread processing
+        # them (see set_roi and apply_roi). Frames grabbed before the
+        # change are dropped, and counted in n_dropped.
+        self.roi_request = None
+        self.roi_applied = None
+        self.roi_time = 0.0
+        self.n_dropped = 0
+        if ccfg.sensor_roi:
+            self.set_roi()
+            self.apply_roi()
+
         self.frame_timer = FrameTimer('Sensor',verbose=False)
-        self.reconstructor = Reconstructor(self.search_boxes.x,
-                                           self.search_boxes.y,self.mask)
+        self.reconstructor = get_reconstructor(self.search_boxes.x,
+                                               self.search_boxes.y,self.mask)
+
+        # Two preallocated frames: sense writes into the back frame and
+        # then makes it the front frame, so readers always see the last
+        # complete frame.
+        self.frames = [self.make_frame(),self.make_frame()]
+        self.frame = self.frames[0]
+        self.frame.image = np.zeros((ccfg.image_height_px,ccfg.image_width_px))
+        self.frame_count = 0
+
+        self.telemetry = TelemetryLogger('sensor',
+                                         [('frame_id',(),np.int64),
+                                          ('x_slopes',(n_lenslets,),np.float64),
+                                          ('y_slopes',(n_lenslets,),np.float64),
+                                          ('x_centroids',(n_lenslets,),np.float64),
+                                          ('y_centroids',(n_lenslets,),np.float64),
+                                          ('ref_x',(n_lenslets,),np.float64),
+                                          ('ref_y',(n_lenslets,),np.float64),
+                                          ('zernikes',(self.reconstructor.N,),np.float64),
+                                          ('error',(),np.float64),
+                                          ('tip',(),np.float64),
+                                          ('tilt',(),np.float64)])
         self.logging = False
+        self.capture = ImageCapture()
         self.paused = False
         
     @pyqtSlot()
     def update(self):
         if not self.paused:
+            # a frame is captured only if it was sensed
             try:
-                self.sense()
+                if self.sense():
+                    frame = self.get_frame()
+                    self.capture.push(frame.image,frame.frame_id)
             except Exception as e:
                 print e
             if self.logging:
@@ -111,25 +203,22 @@ class Sensor(QObject):
         #self.sense()
 
     def log(self):
-        outfn = os.path.join(ccfg.logging_directory,'sensor_%s.mat'%(now_string(True)))
-        d = {}
-        d['x_slopes'] = self.x_slopes
-        d['y_slopes'] = self.y_slopes
-        d['x_centroids'] = self.x_centroids
-        d['y_centroids'] = self.y_centroids
-        d['search_box_x1'] = self.search_boxes.x1
-        d['search_box_x2'] = self.search_boxes.x2
-        d['search_box_y1'] = self.search_boxes.y1
-        d['search_box_y2'] = self.search_boxes.y2
-        d['ref_x'] = self.search_boxes.x
-        d['ref_y'] = self.search_boxes.y
-        d['error'] = self.error
-        d['tip'] = self.tip
-        d['tilt'] = self.tilt
-        d['wavefront'] = self.wavefront
-        d['zernikes'] = self.zernikes
-        
-        sio.savemat(outfn,d)
+        frame = self.get_frame()
+        self.telemetry.record(frame_id=frame.frame_id,
+                              x_slopes=frame.x_slopes,
+                              y_slopes=frame.y_slopes,
+                              x_centroids=frame.x_centroids,
+                              y_centroids=frame.y_centroids,
+                              ref_x=self.search_boxes.x,
+                              ref_y=self.search_boxes.y,
+                              zernikes=frame.zernikes,
+                              error=frame.error,
+                              tip=frame.tip,
+                              tilt=frame.tilt)
+
+    def get_frame(self):
+        """Return the last complete SensorFrame."""
+        return self.frame
 
     def set_background_correction(self,val):
         #sensor_mutex.lock()
@@ -138,8 +227,18 @@ class Sensor(QObject):
 
 
     def set_logging(self,val):
+        if val:
+            self.telemetry.start()
+        else:
+            self.telemetry.stop()
         self.logging = val
 
+    def set_capture(self,val):
+        if val:
+            self.capture.start()
+        else:
+            self.capture.stop()
+
 
     def set_defocus(self,val):
         self.pause()
@@ -148,50 +247,140 @@ class Sensor(QObject):
         
         newy = self.y0 + self.reconstructor.defocus_dy*val*ccfg.zernike_dioptric_equivalent
         self.search_boxes.move(newx,newy)
+        if not self.search_boxes.in_roi(self.roi):
+            self.set_roi()
         
         self.unpause()
         
+    def set_roi(self,margin=None):
+        """Request that the camera read out only the bounding box of the
+        search boxes, grown by margin pixels on every side (by default
+        ccfg.sensor_roi_margin_px). The region is changed before the next
+        frame is sensed or processed (see apply_roi), so this may be
+        called from any thread."""
+        if margin is None:
+            margin = self.roi_margin
+        self.roi_request = self.search_boxes.get_roi(margin)
+
+    def apply_roi(self):
+        """Set the camera's region to the one last requested with
+        set_roi, if it has not been set yet. Cameras may grow the region
+        further (see PylonCamera.set_roi)."""
+        # the request is compared, rather than cleared, so that one made
+        # while this runs is not lost
+        request = self.roi_request
+        if request is None or request is self.roi_applied:
+            return
+        self.roi_applied = request
+        self.roi = tuple(self.cam.set_roi(*request))
+        self.roi_time = time.time()
+        print 'Reading out %d x %d pixels at (%d,%d).'%(self.roi[2],self.roi[3],self.roi[0],self.roi[1])
+
+    def make_frame(self):
+        return SensorFrame(self.n_lenslets,self.reconstructor.N,self.mask.shape)
+
     def sense(self):
+        """Grab and process an image, and return True, or False if it was
+        dropped (see process)."""
+        if self.frame is self.frames[0]:
+            frame = self.frames[1]
+        else:
+            frame = self.frames[0]
+        # change the region before grabbing, so the image is not dropped
+        self.apply_roi()
         image = self.cam.get_image()
+        if not self.process(image,frame,self.cam.metadata):
+            return False
+        # publish the completed frame
+        self.frame = frame
+        return True
+
+    def process(self,image,frame,metadata=None):
+        """Compute the sensor outputs for image, writing them into frame,
+        a SensorFrame (see make_frame), along with the image's
+        FrameMetadata, if given, and return True. The sensor's own frames
+        are not changed.
+
+        A region of interest requested with set_roi is applied first.
+        An image read out with a previous region, i.e. one whose shape
+        differs from the region's or whose metadata predates the change,
+        is dropped: frame is left unchanged and False is returned."""
+        # The image is only read, so it may be a read-only view or a
+        # camera buffer in its native dtype. Background-subtracted pixels
+        # are written over a copy of the image in the frame's own
+        # processed_image, for display.
+        self.apply_roi()
+        x_offset,y_offset,width,height = self.roi
+        if image.shape!=(height,width) or (metadata is not None and metadata.timestamp<self.roi_time):
+            self.n_dropped+=1
+            return False
+        processed_image = None
+        if self.processed_image:
+            if frame.processed_image is None or frame.processed_image.shape!=image.shape or frame.processed_image.dtype!=image.dtype:
+                frame.processed_image = np.empty_like(image)
+            np.copyto(frame.processed_image,image)
+            processed_image = frame.processed_image
         sb = self.search_boxes
-        xr = np.zeros(self.search_boxes.x.shape)
-        xr[:] = self.search_boxes.x[:]
-        yr = np.zeros(self.search_boxes.y.shape)
-        yr[:] = self.search_boxes.y[:]
-        half_width = sb.half_width
-        for iteration in range(self.centroiding_iterations):
-            #QApplication.processEvents()
-            msi = iteration==self.centroiding_iterations-1
-            centroid.compute_centroids(spots_image=image,
-                                       sb_x1_vec=sb.x1,
-                                       sb_x2_vec=sb.x2,
-                                       sb_y1_vec=sb.y1,
-                                       sb_y2_vec=sb.y2,
-                                       x_out=xr,
-                                       y_out=yr,
-                                       mean_intensity = self.box_means,
-                                       maximum_intensity = self.box_maxes,
-                                       minimum_intensity = self.box_mins,
-                                       background_intensity = self.box_backgrounds,
-                                       estimate_background = self.estimate_background,
-                                       background_correction = self.background_correction,
-                                       num_threads = 1,
-                                       modify_spots_image = msi)
-            half_width-=self.iterative_centroiding_step
-            sb = SearchBoxes(xr,yr,half_width)
-            
-        self.x_centroids[:] = xr[:]
-        self.y_centroids[:] = yr[:]
-        self.x_slopes = (self.x_centroids-self.search_boxes.x)*self.pixel_size_m/self.lenslet_focal_length_m
-        self.y_slopes = (self.y_centroids-self.search_boxes.y)*self.pixel_size_m/self.lenslet_focal_length_m
-        self.tilt = np.mean(self.x_slopes)
-        self.tip = np.mean(self.y_slopes)
+        xr = frame.x_centroids
+        yr = frame.y_centroids
+        if self.centroiding_iterations==1 and hasattr(self.centroider,'compute_centroids_indexed'):
+            # gather search box pixels with the boxes' cached index tables
+            xr[:] = sb.x[:]
+            yr[:] = sb.y[:]
+            self.centroider.compute_centroids_indexed(spots_image=image,
+                                                      index_tables=sb.get_index_tables(width,x_offset,y_offset,height),
+                                                      x_out=xr,
+                                                      y_out=yr,
+                                                      mean_intensity = frame.box_means,
+                                                      maximum_intensity = frame.box_maxes,
+                                                      minimum_intensity = frame.box_mins,
+                                                      background_intensity = frame.box_backgrounds,
+                                                      estimate_background = self.estimate_background,
+                                                      background_correction = self.background_correction,
+                                                      processed_image = processed_image)
+        else:
+            # search box centers in the region's coordinates
+            np.subtract(sb.x,x_offset,out=self.roi_x)
+            np.subtract(sb.y,y_offset,out=self.roi_y)
+            self.centroider.compute_centroids_iterative(spots_image=image,
+                                                        x_in=self.roi_x,
+                                                        y_in=self.roi_y,
+                                                        half_width=sb.half_width,
+                                                        step=self.iterative_centroiding_step,
+                                                        n_iterations=self.centroiding_iterations,
+                                                        x_out=xr,
+                                                        y_out=yr,
+                                                        mean_intensity = frame.box_means,
+                                                        maximum_intensity = frame.box_maxes,
+                                                        minimum_intensity = frame.box_mins,
+                                                        background_intensity = frame.box_backgrounds,
+                                                        estimate_background = self.estimate_background,
+                                                        background_correction = self.background_correction,
+                                                        num_threads = self.centroiding_num_threads,
+                                                        processed_image = processed_image)
+            xr+=x_offset
+            yr+=y_offset
+        slope_scale = self.pixel_size_m/self.lenslet_focal_length_m
+        np.subtract(xr,sb.x,out=frame.x_slopes)
+        np.subtract(yr,sb.y,out=frame.y_slopes)
+        frame.x_slopes*=slope_scale
+        frame.y_slopes*=slope_scale
+        frame.tilt = np.mean(frame.x_slopes)
+        frame.tip = np.mean(frame.y_slopes)
         if self.remove_tip_tilt:
-            self.x_slopes-=self.tilt
-            self.y_slopes-=self.tip
-        self.image = image
+            frame.x_slopes-=frame.tilt
+            frame.y_slopes-=frame.tip
+        frame.image = image
+        frame.metadata = metadata
+        frame.roi = self.roi
         if self.reconstruct_wavefront:
-            self.zernikes,self.wavefront,self.error = self.reconstructor.get_wavefront(self.x_slopes,self.y_slopes)
+            frame.error = self.reconstructor.get_wavefront(frame.x_slopes,frame.y_slopes,
+                                                           frame.zernikes,frame.wavefront,
+                                                           compute_map=self.wavefront_map)[2]
+        frame.frame_id = self.frame_count
+        frame.timestamp = time.time()
+        self.frame_count+=1
+        return True
 
     
     def record_reference(self):
@@ -203,12 +392,14 @@ class Sensor(QObject):
             print 'measurement %d of %d'%(k+1,ccfg.reference_n_measurements),
             self.sense()
             print '...done'
-            xcent.append(self.x_centroids)
-            ycent.append(self.y_centroids)
+            xcent.append(self.x_centroids.copy())
+            ycent.append(self.y_centroids.copy())
             
         x_ref = np.array(xcent).mean(0)
         y_ref = np.array(ycent).mean(0)
         self.search_boxes = SearchBoxes(x_ref,y_ref,self.search_boxes.half_width)
+        if not self.search_boxes.in_roi(self.roi):
+            self.set_roi()
         outfn = os.path.join(ccfg.reference_directory,prepend('coords.txt',now_string()))
         refxy = np.array((x_ref,y_ref)).T
         np.savetxt(outfn,refxy,fmt='%0.2f')
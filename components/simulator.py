@@ -0,0 +1,214 @@
+"""Synthetic Shack-Hartmann images, driven by the mirror.
+
+SyntheticCamera renders spots images from a simple physical model,
+instead of replaying recorded frames, so that the loop can be closed in
+simulation: poke matrices measured with it are meaningful, and closed-loop
+convergence can be benchmarked without hardware.
+
+The lenslets are laid out on the nominal grid of the reference mask (see
+reference_generator.get_lenslet_grid), centered on the sensor. The slope
+in each lenslet is the sum of an injected aberration, specified by
+Zernike coefficients and evaluated like the Reconstructor does, and the
+slope of the mirror surface, modeled as a sum of Gaussian influence
+functions centered on the actuators in Mirror.mask. Slopes are converted
+to spot displacements using the lenslet focal length, and every spot is
+rendered as a separable Gaussian into a small box. The boxes of all
+lenslets are computed with a few array operations and written into a
+preallocated image through a strided view, so the cost per frame is
+dominated by filling the image with the background, which set_roi
+limits to a region of interest.
+
+"""
+
+import numpy as np
+from ciao import config as ccfg
+from reference_generator import get_lenslet_grid
+from search_boxes import SearchBoxes
+from zernike import Zernike
+from centroid_numpy import get_windows
+from opacity import OpacityModel
+from camera_interface import Camera
+
+class SyntheticCamera(Camera):
+
+    def __init__(self,mirror=None,aberration=None,n_buffers=2):
+        """Create a synthetic camera.
+
+        Args:
+
+          mirror (Mirror): the mirror whose command shapes the wavefront;
+            may also be set later, with set_mirror
+
+          aberration (dict): Zernike coefficients, in meters, keyed by
+            index j, of the aberration injected in addition to the
+            mirror; defaults to ccfg.simulator_aberration_m
+
+          n_buffers (int): number of images returned by get_image,
+            which are reused in rotation;
+            the Sensor keeps two frames, so at least two are needed
+        """
+        self.sy = ccfg.image_height_px
+        self.sx = ccfg.image_width_px
+        Camera.__init__(self,self.sx,self.sy,ccfg.camera_exposure_us)
+        self.pixel_size_m = ccfg.pixel_size_m
+        self.lenslet_focal_length_m = ccfg.lenslet_focal_length_m
+        self.pupil_radius_m = ccfg.beam_diameter_m/2.0
+
+        # lenslet geometry, centered on the sensor
+        self.lenslet_mask = np.loadtxt(ccfg.reference_mask_filename)
+        my,mx = self.lenslet_mask.shape
+        stride = ccfg.lenslet_pitch_m/ccfg.pixel_size_m
+        xy = get_lenslet_grid(self.lenslet_mask,(self.sx-mx*stride)/2.0,(self.sy-my*stride)/2.0)
+        self.x_ref = xy[:,0]
+        self.y_ref = xy[:,1]
+        self.n_lenslets = len(self.x_ref)
+        self.search_boxes = SearchBoxes(self.x_ref.copy(),self.y_ref.copy(),ccfg.search_box_half_width)
+
+        # lenslet centers in the pupil, in meters and in unit pupil
+        self.x_pupil_m = (self.x_ref-self.x_ref.mean())*self.pixel_size_m
+        self.y_pupil_m = (self.y_ref-self.y_ref.mean())*self.pixel_size_m
+        self.x_unit = self.x_pupil_m/self.pupil_radius_m
+        self.y_unit = self.y_pupil_m/self.pupil_radius_m
+
+        # spot rendering: the Gaussian approximation to a lenslet's
+        # diffraction-limited PSF, and boxes large enough to contain it
+        fwhm_px = 1.02*ccfg.wavelength_m*self.lenslet_focal_length_m/ccfg.lenslet_pitch_m/self.pixel_size_m
+        self.spot_sigma_px = max(fwhm_px/2.355,0.5)
+        self.box_half_width = int(np.ceil(4*self.spot_sigma_px))
+        self.box_width = 2*self.box_half_width+1
+        self.spot_amplitude = ccfg.simulator_spot_amplitude
+        self.box_offsets = np.arange(self.box_width,dtype=np.float)
+        self.gx = np.zeros((self.n_lenslets,self.box_width))
+        self.gy = np.zeros((self.n_lenslets,self.box_width))
+        self.boxes = np.zeros((self.n_lenslets,self.box_width,self.box_width))
+
+        # background, with optional read noise drawn from a small bank of
+        # precomputed frames, since generating full-frame noise every
+        # frame would cost more than rendering the spots
+        background = ccfg.simulator_background
+        noise = ccfg.simulator_read_noise
+        if noise>0:
+            self.backgrounds = np.round(background+np.random.randn(ccfg.simulator_n_noise_frames,self.sy,self.sx)*noise).astype(np.int16)
+        else:
+            self.backgrounds = np.ones((1,self.sy,self.sx),dtype=np.int16)*int(round(background))
+        self.background_index = 0
+
+        self.n_buffers = n_buffers
+        self.buffers = [None]*n_buffers
+
+        self.x_slopes = np.zeros(self.n_lenslets)
+        self.y_slopes = np.zeros(self.n_lenslets)
+        self.mirror = None
+        if mirror is not None:
+            self.set_mirror(mirror)
+        if aberration is None:
+            aberration = ccfg.simulator_aberration_m
+        self.set_aberration(aberration)
+
+        self.opacity = False
+        self.opacity_model = OpacityModel((self.sy,self.sx),n_buffers=n_buffers)
+
+    def set_mirror(self,mirror):
+        """Use mirror's command to shape the wavefront. The slopes of the
+        mirror surface at each lenslet are linear in the command, so they
+        are precomputed as two (n_lenslets,n_actuators) matrices."""
+        self.mirror = mirror
+        my,mx = mirror.mask.shape
+        pitch_m = 2*self.pupil_radius_m/float(max(mx,my)-1)
+        ay,ax = np.where(mirror.mask)
+        x_act_m = (ax-(mx-1)/2.0)*pitch_m
+        y_act_m = (ay-(my-1)/2.0)*pitch_m
+        sigma_m = ccfg.simulator_influence_width*pitch_m
+
+        dx = self.x_pupil_m[:,np.newaxis]-x_act_m
+        dy = self.y_pupil_m[:,np.newaxis]-y_act_m
+        influence = np.exp(-(dx**2+dy**2)/(2*sigma_m**2))
+
+        # the reflected wavefront is twice the surface
+        scale = 2.0*ccfg.simulator_mirror_stroke_m/sigma_m**2
+        self.mirror_x_slope_matrix = -scale*dx*influence
+        self.mirror_y_slope_matrix = -scale*dy*influence
+        self.mirror_flat = np.array(mirror.flat)
+
+    def set_aberration(self,aberration):
+        """Set the injected aberration, a dict of Zernike coefficients in
+        meters keyed by index j, and precompute its slopes."""
+        self.aberration = dict(aberration)
+        self.aberration_x_slopes = np.zeros(self.n_lenslets)
+        self.aberration_y_slopes = np.zeros(self.n_lenslets)
+        Z = Zernike()
+        for j,coef in self.aberration.items():
+            n,m = Z.j2nm(j)
+            self.aberration_x_slopes+=coef*Z.get_surface(n,m,self.x_unit,self.y_unit,kind='dx')/self.pupil_radius_m
+            self.aberration_y_slopes+=coef*Z.get_surface(n,m,self.x_unit,self.y_unit,kind='dy')/self.pupil_radius_m
+
+    def get_search_boxes(self):
+        return self.search_boxes,self.lenslet_mask
+
+    def set_roi(self,x,y,width,height):
+        """Render only the region (x,y,width,height) of the sensor, and
+        return the region."""
+        x,y,width,height = Camera.set_roi(self,x,y,width,height)
+        self.opacity_model = OpacityModel((height,width),n_buffers=self.n_buffers)
+        return self.roi
+
+    def set_opacity(self,val):
+        self.opacity = val
+
+    def get_opacity(self):
+        return self.opacity
+
+    def compute_slopes(self):
+        """Compute the current slope in every lenslet, in radians."""
+        self.x_slopes[:] = self.aberration_x_slopes
+        self.y_slopes[:] = self.aberration_y_slopes
+        if self.mirror is not None:
+            command = self.mirror.get_command()-self.mirror_flat
+            self.x_slopes+=np.dot(self.mirror_x_slope_matrix,command)
+            self.y_slopes+=np.dot(self.mirror_y_slope_matrix,command)
+        return self.x_slopes,self.y_slopes
+
+    def render(self,xc,yc,out):
+        """Add Gaussian spots centered on (xc,yc), in out's pixel
+        coordinates, to out."""
+        hw = self.box_half_width
+        w = self.box_width
+        sy,sx = out.shape
+        x1 = np.clip(np.rint(xc).astype(np.intp)-hw,0,sx-w)
+        y1 = np.clip(np.rint(yc).astype(np.intp)-hw,0,sy-w)
+
+        # separable spots: one row and one column profile per lenslet
+        np.add(x1[:,np.newaxis],self.box_offsets,out=self.gx)
+        self.gx-=xc[:,np.newaxis]
+        np.add(y1[:,np.newaxis],self.box_offsets,out=self.gy)
+        self.gy-=yc[:,np.newaxis]
+        for g in [self.gx,self.gy]:
+            np.square(g,out=g)
+            g*=(-0.5/self.spot_sigma_px**2)
+            np.exp(g,out=g)
+        self.gy*=self.spot_amplitude
+        np.multiply(self.gy[:,:,np.newaxis],self.gx[:,np.newaxis,:],out=self.boxes)
+
+        windows = get_windows(out,w,w)
+        self.boxes+=windows[y1,x1]
+        windows[y1,x1] = np.rint(self.boxes)
+
+    def grab_into(self,buffer=None):
+        """Render the spots for the mirror's current command into buffer
+        (allocated if None, or if its shape or dtype differs), and return
+        (buffer,metadata)."""
+        x_slopes,y_slopes = self.compute_slopes()
+        scale = self.lenslet_focal_length_m/self.pixel_size_m
+        x,y,width,height = self.roi
+        xc = self.x_ref+x_slopes*scale-x
+        yc = self.y_ref+y_slopes*scale-y
+
+        if buffer is None or buffer.shape!=(height,width) or buffer.dtype!=np.int16:
+            buffer = np.empty((height,width),dtype=np.int16)
+        buffer[...] = self.backgrounds[self.background_index,y:y+height,x:x+width]
+        self.background_index = (self.background_index+1)%len(self.backgrounds)
+        self.render(xc,yc,buffer)
+
+        if self.opacity:
+            np.copyto(buffer,self.opacity_model.apply(buffer))
+        return buffer,self.make_metadata()
@@ -0,0 +1,339 @@
+"""Buffered binary telemetry logging.
+
+A TelemetryLogger records a fixed set of named fields (e.g. slopes,
+centroids, mirror commands) once per frame. Records are copied into a
+preallocated in-memory ring buffer, which is cheap enough to do from the
+real-time threads; a background writer thread appends the buffered
+records to disk in chunks.
+
+Each logging session is written to its own directory, containing a
+plain-text header (header.txt) that lists the fields, and one raw binary
+file per field, to which records are appended. TelemetryReader opens a
+session directory and memory-maps each field as an (n_frames,...) array,
+so that long sessions can be analyzed without loading them into RAM.
+
+ImageCapture records raw camera frames in the same spirit: frames are
+copied into a small pool of preallocated buffers and streamed by a writer
+thread into a single preallocated, memory-mapped .npy stack.
+
+"""
+
+import numpy as np
+import threading
+import time
+import os
+import Queue
+from ciao import config as ccfg
+from tools import now_string
+
+class TelemetryLogger:
+
+    def __init__(self,name,fields,buffer_size=None,chunk_size=None):
+        """Create a logger.
+
+        Args:
+
+          name (str): a label, used to name session directories
+
+          fields (list): (field_name,shape,dtype) tuples describing
+            the quantities recorded in each frame; a 'timestamp' field is
+            added automatically
+
+          buffer_size (int): number of frames held in the ring buffer;
+            defaults to ccfg.telemetry_buffer_size
+
+          chunk_size (int): number of frames accumulated before the
+            writer thread appends them to disk; defaults to
+            ccfg.telemetry_chunk_size
+        """
+        if buffer_size is None:
+            buffer_size = ccfg.telemetry_buffer_size
+        if chunk_size is None:
+            chunk_size = ccfg.telemetry_chunk_size
+        self.name = name
+        self.buffer_size = buffer_size
+        self.chunk_size = min(chunk_size,buffer_size)
+        self.fields = [('timestamp',(),np.dtype(np.float64))]+[(fn,tuple(shape),np.dtype(dtype)) for fn,shape,dtype in fields]
+        self.buffers = {}
+        for fn,shape,dtype in self.fields:
+            self.buffers[fn] = np.zeros((buffer_size,)+shape,dtype=dtype)
+
+        # n_recorded is only advanced by the recording thread, and
+        # n_flushed only by the writer thread, so the ring buffer needs
+        # no lock.
+        self.n_recorded = 0
+        self.n_flushed = 0
+        self.n_dropped = 0
+        self.directory = None
+        self.files = {}
+        self.running = False
+        self.data_ready = threading.Event()
+        self.thread = None
+
+    def start(self,directory=None):
+        """Start a new logging session, in directory if specified, or in
+        a new timestamped directory in ccfg.logging_directory otherwise."""
+        if self.running:
+            return
+        if directory is None:
+            directory = os.path.join(ccfg.logging_directory,'%s_%s'%(now_string(),self.name))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+        with open(os.path.join(directory,'header.txt'),'w') as fid:
+            for fn,shape,dtype in self.fields:
+                fid.write('%s %s %s\n'%(fn,dtype.str,','.join(['%d'%s for s in shape])))
+        self.files = {}
+        for fn,shape,dtype in self.fields:
+            self.files[fn] = open(os.path.join(directory,'%s.bin'%fn),'ab')
+
+        self.n_recorded = 0
+        self.n_flushed = 0
+        self.n_dropped = 0
+        self.running = True
+        self.data_ready.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the session, writing any buffered records to disk."""
+        if not self.running:
+            return
+        self.running = False
+        self.data_ready.set()
+        self.thread.join()
+        self.flush()
+        for fid in self.files.values():
+            fid.close()
+        self.files = {}
+        if self.n_dropped:
+            print '%s telemetry: %d frames dropped'%(self.name,self.n_dropped)
+
+    def record(self,**values):
+        """Copy one frame of values, passed as keyword arguments named by
+        field, into the ring buffer. Fields that are not passed keep
+        their value from the last time their slot was used. If the
+        writer has fallen a full buffer behind, the frame is dropped and
+        counted in n_dropped, so that the caller never blocks."""
+        if not self.running:
+            return
+        if self.n_recorded-self.n_flushed>=self.buffer_size:
+            self.n_dropped+=1
+            return
+        slot = self.n_recorded%self.buffer_size
+        self.buffers['timestamp'][slot] = time.time()
+        for fn,val in values.items():
+            self.buffers[fn][slot] = val
+        self.n_recorded+=1
+        if self.n_recorded-self.n_flushed>=self.chunk_size:
+            self.data_ready.set()
+
+    def run(self):
+        while self.running:
+            self.data_ready.wait(1.0)
+            self.data_ready.clear()
+            self.flush()
+
+    def flush(self):
+        # append all complete records to the files; records wrap around
+        # the end of the ring buffer, so write up to two slices per field
+        n_recorded = self.n_recorded
+        while self.n_flushed<n_recorded:
+            start = self.n_flushed%self.buffer_size
+            end = min(start+n_recorded-self.n_flushed,self.buffer_size)
+            for fn,shape,dtype in self.fields:
+                self.buffers[fn][start:end].tofile(self.files[fn])
+            self.n_flushed+=end-start
+        for fid in self.files.values():
+            fid.flush()
+
+
+class TelemetryReader:
+
+    def __init__(self,directory):
+        """Open a session written by TelemetryLogger.
+
+        Each field is memory-mapped as a read-only array with one row per
+        frame; they are available as attributes and by indexing the
+        reader with the field name, e.g. reader['x_slopes'].
+        """
+        self.directory = directory
+        self.fields = []
+        self.arrays = {}
+        n_frames = None
+        with open(os.path.join(directory,'header.txt')) as fid:
+            for line in fid.readlines():
+                items = line.split()
+                if not items:
+                    continue
+                fn,dtype = items[0],np.dtype(items[1])
+                if len(items)>2:
+                    shape = tuple([int(s) for s in items[2].split(',')])
+                else:
+                    shape = ()
+                self.fields.append((fn,shape,dtype))
+                frame_bytes = dtype.itemsize*int(np.prod(shape))
+                n = os.path.getsize(os.path.join(directory,'%s.bin'%fn))//frame_bytes
+                if n_frames is None or n<n_frames:
+                    n_frames = n
+
+        # if the session was interrupted, some fields may contain an
+        # extra frame; use only complete frames
+        self.n_frames = n_frames
+        for fn,shape,dtype in self.fields:
+            if n_frames:
+                self.arrays[fn] = np.memmap(os.path.join(directory,'%s.bin'%fn),
+                                            dtype=dtype,mode='r',
+                                            shape=(n_frames,)+shape)
+            else:
+                self.arrays[fn] = np.zeros((0,)+shape,dtype=dtype)
+            setattr(self,fn,self.arrays[fn])
+
+    def __getitem__(self,field_name):
+        return self.arrays[field_name]
+
+    def __len__(self):
+        return self.n_frames
+
+
+class ImageCapture:
+
+    def __init__(self,every_n=None,max_frames=None,queue_size=None):
+        """Create a raw image capture.
+
+        Args:
+
+          every_n (int): capture every Nth frame passed to push; defaults
+            to ccfg.capture_every_n
+
+          max_frames (int): size of the on-disk stack; when it is full,
+            further frames are dropped; defaults to
+            ccfg.capture_max_frames
+
+          queue_size (int): number of frames that may wait in memory for
+            the writer; defaults to ccfg.capture_queue_size
+        """
+        if every_n is None:
+            every_n = ccfg.capture_every_n
+        if max_frames is None:
+            max_frames = ccfg.capture_max_frames
+        if queue_size is None:
+            queue_size = ccfg.capture_queue_size
+        self.every_n = every_n
+        self.max_frames = max_frames
+        self.queue_size = queue_size
+        self.pool = None
+        self.stack = None
+        self.filename = None
+        self.running = False
+        self.thread = None
+
+    def start(self,filename=None):
+        """Start capturing into filename, or into a new timestamped .npy
+        file in ccfg.logging_directory. The stack and buffer pool are
+        allocated when the first frame arrives, using its shape and
+        dtype."""
+        if self.running:
+            return
+        if filename is None:
+            if not os.path.exists(ccfg.logging_directory):
+                os.makedirs(ccfg.logging_directory)
+            filename = os.path.join(ccfg.logging_directory,'%s_spots.npy'%now_string())
+        self.filename = filename
+        self.pool = None
+        self.stack = None
+        self.frame_ids = np.zeros(self.max_frames,dtype=np.int64)
+        self.free_slots = Queue.Queue()
+        self.full_slots = Queue.Queue()
+        self.n_pushed = 0
+        self.n_queued = 0
+        self.n_written = 0
+        self.n_dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop capturing, after writing any queued frames. The ids of the
+        captured frames are saved next to the stack, in a text file."""
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        if self.stack is not None:
+            self.stack.flush()
+            self.stack = None
+        np.savetxt(os.path.splitext(self.filename)[0]+'_frame_ids.txt',
+                   self.frame_ids[:self.n_written],fmt='%d')
+        print 'captured %d frames (%d dropped) in %s'%(self.n_written,self.n_dropped,self.filename)
+
+    def allocate(self,image):
+        self.pool = np.zeros((self.queue_size,)+image.shape,dtype=image.dtype)
+        for slot in range(self.queue_size):
+            self.free_slots.put(slot)
+        self.stack = np.lib.format.open_memmap(self.filename,mode='w+',dtype=image.dtype,
+                                               shape=(self.max_frames,)+image.shape)
+
+    def restart(self):
+        """Finish the current stack and continue in a new file, next to
+        it."""
+        directory = os.path.dirname(self.filename)
+        self.stop()
+        self.start(os.path.join(directory,'%s_spots.npy'%now_string(ms=True)))
+
+    def push(self,image,frame_id=-1):
+        """Offer a frame for capture. Only every Nth frame is kept; it is
+        copied into a free buffer and queued for the writer. If no buffer
+        is free (the disk has fallen behind) or the stack is full, the
+        frame is dropped and counted, rather than blocking the caller.
+        A stack holds frames of one shape, so a frame of another (e.g.
+        after the sensor's region of interest changes) restarts the
+        capture in a new file."""
+        if not self.running or image is None:
+            return
+        if self.pool is not None and (image.shape!=self.pool.shape[1:] or image.dtype!=self.pool.dtype):
+            self.restart()
+        self.n_pushed+=1
+        if (self.n_pushed-1)%self.every_n:
+            return
+        if self.pool is None:
+            self.allocate(image)
+        if self.n_queued>=self.max_frames:
+            self.n_dropped+=1
+            return
+        try:
+            slot = self.free_slots.get_nowait()
+        except Queue.Empty:
+            self.n_dropped+=1
+            return
+        try:
+            self.pool[slot][...] = image
+        except Exception:
+            self.free_slots.put(slot)
+            self.n_dropped+=1
+            raise
+        self.n_queued+=1
+        self.full_slots.put((slot,frame_id))
+
+    def run(self):
+        while self.running or not self.full_slots.empty():
+            try:
+                slot,frame_id = self.full_slots.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            self.stack[self.n_written] = self.pool[slot]
+            self.frame_ids[self.n_written] = frame_id
+            self.n_written+=1
+            self.free_slots.put(slot)
+
+
+def load_capture(filename):
+    """Return (frames,frame_ids) for a capture written by ImageCapture.
+    frames is a read-only memory map containing only the frames that
+    were written."""
+    frame_ids = np.atleast_1d(np.loadtxt(os.path.splitext(filename)[0]+'_frame_ids.txt',dtype=np.int64))
+    frames = np.load(filename,mmap_mode='r')
+    return frames[:len(frame_ids)],frame_ids
@@ -1,6 +1,5 @@
 import numpy as np
 import time
-import centroid
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -257,10 +256,17 @@ class ImageDisplay(QWidget):
         
 class UI(QWidget):
 
-    def __init__(self,loop):
+    def __init__(self,loop,pipeline=None):
         super(UI,self).__init__()
         self.loop = loop
-        self.loop.finished.connect(self.update)
+        self.pipeline = pipeline
+        if pipeline is None:
+            self.loop.finished.connect(self.update)
+        else:
+            # the pipeline runs without Qt, so poll its snapshots
+            self.timer = QTimer()
+            self.timer.timeout.connect(self.update)
+            self.timer.start(ccfg.pipeline_snapshot_interval_s*1000.0)
         self.init_UI()
         self.frame_timer = FrameTimer('UI',verbose=False)
         self.show()
@@ -305,11 +311,15 @@ class UI(QWidget):
         self.cb_logging.setChecked(False)
         self.cb_logging.stateChanged.connect(self.loop.sensor.set_logging)
         self.cb_logging.stateChanged.connect(self.loop.mirror.set_logging)
+
+        self.cb_capture = QCheckBox('Capture spots')
+        self.cb_capture.setChecked(False)
+        self.cb_capture.stateChanged.connect(self.loop.sensor.set_capture)
         
         self.pb_poke = QPushButton('Poke')
-        self.pb_poke.clicked.connect(self.loop.run_poke)
+        self.pb_poke.clicked.connect(self.run_poke)
         self.pb_record_reference = QPushButton('Record reference')
-        self.pb_record_reference.clicked.connect(self.loop.sensor.record_reference)
+        self.pb_record_reference.clicked.connect(self.record_reference)
         self.pb_flatten = QPushButton('&Flatten')
         self.pb_flatten.clicked.connect(self.loop.mirror.flatten)
         self.pb_quit = QPushButton('&Quit')
@@ -382,43 +392,79 @@ class UI(QWidget):
         column_2.addWidget(self.pb_poke)
         column_2.addWidget(self.pb_record_reference)
         column_2.addWidget(self.cb_logging)
+        column_2.addWidget(self.cb_capture)
         
         layout.addLayout(column_2)
         
         self.setLayout(layout)
         
 
+    # Poking and recording a reference grab with Sensor.sense, so with a
+    # pipeline they run while it is stopped.
+    def run_poke(self):
+        if self.pipeline is None:
+            self.loop.run_poke()
+        else:
+            self.pipeline.run_stopped(self.loop.run_poke)
+
+    def record_reference(self):
+        if self.pipeline is None:
+            self.loop.sensor.record_reference()
+        else:
+            self.pipeline.run_stopped(self.loop.sensor.record_reference)
+
     @pyqtSlot()
     def update(self):
         
         try:
             sensor = self.loop.sensor
             mirror = self.loop.mirror
+            if self.pipeline is None:
+                frame = sensor.get_frame()
+                command = mirror.get_command()
+                active_lenslets = self.loop.active_lenslets
+            else:
+                snapshot = self.pipeline.get_snapshot()
+                if snapshot is None:
+                    return
+                frame = snapshot.frame
+                command = snapshot.command
+                active_lenslets = snapshot.active_lenslets
 
             sb = sensor.search_boxes
 
+            # the image may be a region of the sensor
+            if frame.roi is not None:
+                x0,y0 = frame.roi[:2]
+            else:
+                x0,y0 = 0,0
+
             if self.id_spots.draw_boxes:
-                boxes = [sb.x1,sb.x2,sb.y1,sb.y2]
+                boxes = [sb.x1-x0,sb.x2-x0,sb.y1-y0,sb.y2-y0]
             else:
                 boxes = None
 
             if self.id_spots.draw_lines:
-                lines = [sb.x,sb.x+sensor.x_slopes*ccfg.slope_line_magnification,
-                         sb.y,sb.y+sensor.y_slopes*ccfg.slope_line_magnification]
+                lines = [sb.x-x0,sb.x-x0+frame.x_slopes*ccfg.slope_line_magnification,
+                         sb.y-y0,sb.y-y0+frame.y_slopes*ccfg.slope_line_magnification]
             else:
                 lines = None
                 
-            self.id_spots.show(sensor.image,boxes=boxes,lines=lines,mask=self.loop.active_lenslets)
+            if frame.processed_image is not None:
+                spots = frame.processed_image
+            else:
+                spots = frame.image
+            self.id_spots.show(spots,boxes=boxes,lines=lines,mask=active_lenslets)
 
             mirror_map = np.zeros(mirror.mask.shape)
-            mirror_map[np.where(mirror.mask)] = mirror.get_command()[:]
+            mirror_map[np.where(mirror.mask)] = command[:]
             self.id_mirror.show(mirror_map)
 
-            self.id_wavefront.show(sensor.wavefront)
+            self.id_wavefront.show(frame.wavefront)
             
-            self.lbl_error.setText(ccfg.wavefront_error_fmt%(sensor.error*1e9))
-            self.lbl_tip.setText(ccfg.tip_fmt%(sensor.tip*1000000))
-            self.lbl_tilt.setText(ccfg.tilt_fmt%(sensor.tilt*1000000))
+            self.lbl_error.setText(ccfg.wavefront_error_fmt%(frame.error*1e9))
+            self.lbl_tip.setText(ccfg.tip_fmt%(frame.tip*1000000))
+            self.lbl_tilt.setText(ccfg.tilt_fmt%(frame.tilt*1000000))
             self.lbl_cond.setText(ccfg.cond_fmt%(self.loop.get_condition_number()))
             self.lbl_sensor_fps.setText(ccfg.sensor_fps_fmt%sensor.frame_timer.fps)
             self.lbl_mirror_fps.setText(ccfg.mirror_fps_fmt%mirror.frame_timer.fps)
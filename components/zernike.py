@@ -1,7 +1,9 @@
 """This module contains functions for Zernike calculations. Mainly the private
 function _zgen, a generator function for Zernike polynomials. The public
 functions make use of _zgen to create height or slope maps in a unit
-pupil, corresponding to individual Zernike terms.
+pupil, corresponding to individual Zernike terms. ZernikeBasis evaluates
+many terms at once, sharing the polynomial coefficients (cached by
+Zernike.zeqn) and the powers of the coordinates among terms.
 
 Author: Ravi S. Jonnal / Werner Lab, UC Davis
 
@@ -12,6 +14,10 @@ Revision: 3.0 / 14 March 2019
 import numpy as np
 from matplotlib import pyplot as plt
 import sys,os
+import math
+import glob
+import hashlib
+import shutil
 from ciao import config as ccfg
 
 def fact(num):
@@ -22,11 +28,9 @@ def fact(num):
     # Check that $num\geq 0$.
     assert(num>=0)
     
-    # Compute $num!$ recursively.
-    if num==0 or num==1:
-        return 1
-    else:
-        return num * fact(num-1)
+    # Compute $num!$ with Python integers, which do not overflow for
+    # the large orders used by high-order bases.
+    return math.factorial(int(num))
 
 def choose(a,b):
     """Binomial coefficient, implemented using
@@ -36,6 +40,10 @@ def choose(a,b):
     assert(a>=b)
     return fact(a)/(fact(b)*fact(a-b))
 
+# Coefficient tables computed by Zernike.zeqn, keyed by (n,m,kind). They
+# depend only on the key, so they are shared by all Zernike objects.
+zeqn_cache = {}
+
 class Zernike:
 
     def j2nm(self,j):
@@ -91,7 +99,12 @@ class Zernike:
               onto inner coefficients.
 
         """
-        absm = np.abs(m)
+        key = (n,m,kind.lower())
+        if not forceRecompute and zeqn_cache.has_key(key):
+            return zeqn_cache[key]
+
+        n,m = int(n),int(m)
+        absm = abs(m)
 
         # check that n and m are both even or both odd
         if (float(n-absm))%2.0:
@@ -205,8 +218,9 @@ class Zernike:
                             cdict[termKey] = ct123
 
         # Remove zeros to speed up computations later.
-        cdict = {key: value for key, value in cdict.items() if value}
+        cdict = {termKey: value for termKey, value in cdict.items() if value}
 
+        zeqn_cache[key] = (outerCoef,cdict)
         return (outerCoef,cdict)
 
     def convert_to_surface(self,params,X,Y,mask=None):
@@ -329,48 +343,343 @@ class Zernike:
 
         return matrix_out
 
+    def get_basis(self,N,X,Y,kind='h'):
+        """Return the first N Zernike terms (j = 0...N-1) evaluated at X
+        and Y, as an (N,)+X.shape array. See ZernikeBasis."""
+        return ZernikeBasis(X,Y).get(N,kind)
+
+
+class ZernikeBasis:
+
+    def __init__(self,X,Y):
+        """Evaluate many Zernike terms at one set of coordinates.
+
+        Every term is a sum of monomials X^a Y^b, so the powers of X and
+        Y are computed once, and shared by all terms. The basis is
+        then a single matrix product, of an (N_terms x N_monomials)
+        coefficient matrix and an (N_monomials x N_points) monomial
+        table, instead of a loop over terms and monomials.
+
+        Args:
+
+          X (float): A scalar, vector, or matrix of X coordinates in unit pupil.
+
+          Y (float): A scalar, vector, or matrix of Y coordinates in unit pupil.
+        """
+        X = np.asarray(X,dtype=np.float)
+        Y = np.asarray(Y,dtype=np.float)
+        if not X.shape==Y.shape:
+            errString = 'zernike.ZernikeBasis error: ' + \
+                'X and Y must have the same shape, but X is %s and Y is %s'%(X.shape,Y.shape)
+            sys.exit(errString)
+        self.shape = X.shape
+        self.x = X.ravel()
+        self.y = Y.ravel()
+        self.x_powers = np.ones((1,len(self.x)))
+        self.y_powers = np.ones((1,len(self.y)))
+        self.Z = Zernike()
+
+    def get_powers(self,max_power):
+        # extend the tables of powers of X and Y up to max_power, by
+        # repeated multiplication
+        n_powers = len(self.x_powers)
+        if n_powers>max_power:
+            return
+        x_powers = np.zeros((max_power+1,len(self.x)))
+        y_powers = np.zeros((max_power+1,len(self.y)))
+        x_powers[:n_powers] = self.x_powers
+        y_powers[:n_powers] = self.y_powers
+        for p in range(n_powers,max_power+1):
+            np.multiply(x_powers[p-1],self.x,out=x_powers[p])
+            np.multiply(y_powers[p-1],self.y,out=y_powers[p])
+        self.x_powers = x_powers
+        self.y_powers = y_powers
+
+    def get_coefficients(self,N,kind='h'):
+        """Return (C,exponents): the (N x N_monomials) matrix of
+        normalized coefficients of the first N terms, and the list of
+        (xexp,yexp) exponent pairs corresponding to its columns."""
+        params = []
+        exponents = {}
+        for j in range(N):
+            n,m = self.Z.j2nm(j)
+            params.append(self.Z.zeqn(n,m,kind))
+            for termKey in params[-1][1].keys():
+                if not exponents.has_key(termKey):
+                    exponents[termKey] = len(exponents)
+        C = np.zeros((N,len(exponents)))
+        for j,(outerCoef,cdict) in enumerate(params):
+            normalizer = np.sqrt(outerCoef)
+            for termKey,value in cdict.items():
+                C[j,exponents[termKey]] = value*normalizer
+        exponent_list = sorted(exponents.keys(),key=lambda termKey:exponents[termKey])
+        return C,exponent_list
+
+    def get(self,N,kind='h'):
+        """Return the first N terms of kind 'h', 'dx', or 'dy', as an
+        (N,)+X.shape array."""
+        C,exponent_list = self.get_coefficients(N,kind)
+        if len(exponent_list)==0:
+            return np.zeros((N,)+self.shape)
+        self.get_powers(max([max(termKey) for termKey in exponent_list]))
+        monomials = np.zeros((len(exponent_list),len(self.x)))
+        for k,(xexp,yexp) in enumerate(exponent_list):
+            np.multiply(self.x_powers[xexp],self.y_powers[yexp],out=monomials[k])
+        return np.dot(C,monomials).reshape((N,)+self.shape)
+
+
+def get_reconstructor_key(x,y,mask,n_terms,pupil_size,pixel_size,regularize):
+    """Return a hash of everything the reconstructor matrices depend on."""
+    key = hashlib.sha1()
+    for arr in [x,y,mask]:
+        arr = np.ascontiguousarray(arr,dtype=np.float64)
+        key.update(repr(arr.shape))
+        key.update(arr.tostring())
+    key.update(repr((int(n_terms),float(pupil_size),float(pixel_size),bool(regularize))))
+    return key.hexdigest()
+
+
+class ReconstructorCache:
+
+    def __init__(self,directory=None,max_entries=None):
+        """An on-disk cache of reconstructor matrices.
+
+        Each entry is a directory, named by its key, containing one .npy
+        file per matrix. Entries are loaded as read-only memory maps, so
+        loading costs almost nothing until the matrices are used. The
+        modification time of an entry's directory records when it was
+        last used, and the least recently used entries are removed when
+        there are more than max_entries.
+
+        Args:
+
+          directory (str): defaults to ccfg.reconstructor_cache_directory
+
+          max_entries (int): defaults to ccfg.reconstructor_cache_max_entries
+        """
+        if directory is None:
+            directory = ccfg.reconstructor_cache_directory
+        if max_entries is None:
+            max_entries = ccfg.reconstructor_cache_max_entries
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def load(self,key):
+        """Return a dict of memory-mapped matrices stored under key, or
+        None if there is no such entry."""
+        entry = os.path.join(self.directory,key)
+        if not os.path.isdir(entry):
+            return None
+        arrays = {}
+        for fn in glob.glob(os.path.join(entry,'*.npy')):
+            name = os.path.splitext(os.path.basename(fn))[0]
+            arrays[name] = np.load(fn,mmap_mode='r')
+        os.utime(entry,None)
+        return arrays
+
+    def save(self,key,arrays):
+        """Store a dict of matrices under key, and evict old entries."""
+        entry = os.path.join(self.directory,key)
+        if os.path.isdir(entry):
+            return
+        # write into a temporary directory and rename it, so that a
+        # partially written entry is never loaded
+        temp = entry+'.partial'
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+        for name,arr in arrays.items():
+            np.save(os.path.join(temp,'%s.npy'%name),arr)
+        os.rename(temp,entry)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory,d) for d in os.listdir(self.directory)]
+        entries = [d for d in entries if os.path.isdir(d) and not d.endswith('.partial')]
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:max(len(entries)-self.max_entries,0)]:
+            shutil.rmtree(entry,ignore_errors=True)
+
 
 class Reconstructor:
 
-    def __init__(self,x,y,mask,regularize=False):
+    def __init__(self,x,y,mask,regularize=False,use_cache=None):
         self.pixel_size = ccfg.pixel_size_m
         self.pupil_size = ccfg.beam_diameter_m
         self.N = ccfg.n_zernike_terms
         self.regularize = regularize
         self.mask = mask
-        Z = Zernike()
-        refx = x
-        refy = y
+        if use_cache is None:
+            use_cache = ccfg.reconstructor_use_cache
+
+        # building the matrices is expensive, so they are reused from
+        # the cache if they were computed before for the same geometry
+        arrays = None
+        if use_cache:
+            cache = ReconstructorCache()
+            key = get_reconstructor_key(x,y,mask,self.N,self.pupil_size,
+                                        self.pixel_size,self.regularize)
+            arrays = cache.load(key)
+        if arrays is None:
+            arrays = self.make_matrices(x,y)
+            if use_cache:
+                try:
+                    cache.save(key,arrays)
+                except Exception as e:
+                    print 'Could not cache reconstructor matrices:',e
+
+        self.zernike_matrix = arrays['zernike_matrix']
+        self.wavefront_matrix = arrays['wavefront_matrix']
+        if arrays.has_key('defocus_h'):
+            # the defocus vectors are small, and are used in arithmetic,
+            # so they are copied out of the memory maps
+            self.defocus_h = np.array(arrays['defocus_h'])
+            self.defocus_dx = np.array(arrays['defocus_dx'])
+            self.defocus_dy = np.array(arrays['defocus_dy'])
+        self.wavefront = np.zeros(self.mask.shape)
+
+        # buffers reused by get_wavefront, to avoid allocating per frame
+        self.slopes = np.zeros(self.zernike_matrix.shape[1])
+        self.coefs = np.zeros(self.N)
+        self.wavefront_vec = np.zeros(self.wavefront_matrix.shape[0])
+        self.gram_coefs = np.zeros(self.N)
+        self.make_operators()
+
+    def make_operators(self):
+        # Precompute everything get_wavefront needs beyond the matrices:
+        # the flat indices of the pupil mask, the wavefront matrix with
+        # the pupil scaling folded in, and, for computing the error
+        # without the wavefront map, its Gram matrix and column means.
+        # The wavefront is the mean-subtracted product of the wavefront
+        # matrix and the coefficients, so its variance is
+        # c.G.c-(h.c)**2, with G = Hs.T.Hs/n_points and h the column means
+        # of Hs, the scaled wavefront matrix.
+        self.mask_index = np.flatnonzero(self.mask)
+        scaled = np.array(self.wavefront_matrix)*(self.pupil_size/2.0)
+        self.scaled_wavefront_matrix = scaled
+        self.gram_matrix = np.dot(scaled.T,scaled)/float(len(scaled))
+        self.wavefront_matrix_mean = scaled.mean(axis=0)
+
+        # Computing the map through the coefficients costs N*(n_slopes+
+        # n_points) multiplications, and through the fused operator
+        # n_slopes*n_points; fuse them only if that is cheaper, which
+        # requires many more terms than are normally used.
+        n_points,n_slopes = len(scaled),len(self.slopes)
+        if n_points*n_slopes<self.N*(n_slopes+n_points):
+            self.slopes_to_wavefront = np.dot(scaled,self.zernike_matrix)
+        else:
+            self.slopes_to_wavefront = None
         
-        # convert refx and refy from pixels to unit pupil
-        refx = refx*self.pixel_size/(self.pupil_size/2.0)
+    def get_wavefront(self,xslopes,yslopes,coefs_out=None,wavefront_out=None,compute_map=True):
+        """Reconstruct the wavefront from x and y slopes.
+
+        If coefs_out and wavefront_out are given, the Zernike coefficients
+        and wavefront map are written into them; otherwise they are
+        written into buffers owned by the Reconstructor, which are
+        overwritten by the next call.
+
+        If compute_map is False, only the coefficients and the RMS error
+        are computed, and wavefront_out is left untouched; the error is
+        then computed from the coefficients, without the wavefront.
+
+        Returns:
+
+          tuple: (coefs,wavefront,error)
+        """
+        if coefs_out is None:
+            coefs_out = self.coefs
+        if wavefront_out is None:
+            wavefront_out = self.wavefront
+
+        # the regularization row of self.slopes is always zero
+        n_lenslets = len(xslopes)
+        self.slopes[:n_lenslets] = xslopes
+        self.slopes[n_lenslets:2*n_lenslets] = yslopes
+
+        np.dot(self.zernike_matrix,self.slopes,out=coefs_out)
+        if not compute_map:
+            np.dot(self.gram_matrix,coefs_out,out=self.gram_coefs)
+            variance = np.dot(coefs_out,self.gram_coefs)-np.dot(self.wavefront_matrix_mean,coefs_out)**2
+            return coefs_out,wavefront_out,np.sqrt(max(variance,0.0))
+
+        if self.slopes_to_wavefront is not None:
+            np.dot(self.slopes_to_wavefront,self.slopes,out=self.wavefront_vec)
+        else:
+            np.dot(self.scaled_wavefront_matrix,coefs_out,out=self.wavefront_vec)
+        error = self.wavefront_vec.std()
+        np.put(wavefront_out,self.mask_index,self.wavefront_vec)
+        return coefs_out,wavefront_out,error
+
+    def get_wavefronts(self,x_slopes,y_slopes,chunk_size=None,return_maps=False):
+        """Reconstruct a time series of slopes, e.g. from a TelemetryReader.
+
+        Frames are processed in chunks of chunk_size, each with a single
+        matrix-matrix product, so only one chunk of the slopes needs to
+        be in memory at a time; memory-mapped inputs are read one chunk
+        at a time.
+
+        Args:
+
+          x_slopes, y_slopes (2D arrays): (n_frames,n_lenslets) slopes
+
+          chunk_size (int): frames per chunk; defaults to
+            ccfg.reconstruction_chunk_size
+
+          return_maps (bool): also return a WavefrontMaps object, which
+            computes wavefront maps on demand
+
+        Returns:
+
+          tuple: (coefs,errors), or (coefs,errors,maps) if return_maps;
+            coefs is (n_frames,N) and errors is (n_frames,)
+        """
+        if chunk_size is None:
+            chunk_size = ccfg.reconstruction_chunk_size
+        n_frames,n_lenslets = x_slopes.shape
+        coefs = np.zeros((n_frames,self.N))
+        errors = np.zeros(n_frames)
+
+        # the x and y blocks of the reconstruction matrix; the
+        # regularization column multiplies a zero slope, so it is unused
+        x_matrix = self.zernike_matrix[:,:n_lenslets].T
+        y_matrix = self.zernike_matrix[:,n_lenslets:2*n_lenslets].T
+        temp = np.zeros((chunk_size,self.N))
+        for start in range(0,n_frames,chunk_size):
+            end = min(start+chunk_size,n_frames)
+            c = coefs[start:end]
+            t = temp[:end-start]
+            np.dot(np.asarray(x_slopes[start:end],dtype=np.float),x_matrix,out=c)
+            np.dot(np.asarray(y_slopes[start:end],dtype=np.float),y_matrix,out=t)
+            c+=t
+            # the same variance as in get_wavefront, for every frame
+            np.dot(c,self.gram_matrix,out=t)
+            t*=c
+            variance = t.sum(axis=1)-np.dot(c,self.wavefront_matrix_mean)**2
+            np.sqrt(np.maximum(variance,0.0),out=errors[start:end])
+
+        if return_maps:
+            return coefs,errors,WavefrontMaps(self,coefs)
+        return coefs,errors
+
+    def get_unit_pupil_coordinates(self,x,y):
+        # convert reference coordinates from pixels to unit pupil
+        refx = x*self.pixel_size/(self.pupil_size/2.0)
         refx = refx-refx.mean()
-        refy = refy*self.pixel_size/(self.pupil_size/2.0)
+        refy = y*self.pixel_size/(self.pupil_size/2.0)
         refy = refy-refy.mean()
+        return refx,refy
+
+    def make_matrices(self,x,y):
+        """Compute the reconstruction matrices for reference coordinates
+        x and y, returning them in a dict."""
+        refx,refy = self.get_unit_pupil_coordinates(x,y)
 
         # compute dx and dh for some n,m pairs for first n_terms terms:
         # build these up into matrices for inversion
-        dxmat = []
-        dymat = []
-        hmat = []
-        
-        for j in range(self.N):
-            n,m = Z.j2nm(j)
-            print j,n,m
-            h = Z.get_surface(n,m,refx,refy,kind='h')
-            dx = Z.get_surface(n,m,refx,refy,kind='dx')
-            dy = Z.get_surface(n,m,refx,refy,kind='dy')
-            hmat.append(h)
-            dxmat.append(dx)
-            dymat.append(dy)
-            if j==4:
-                self.defocus_h = h
-                self.defocus_dx = dx
-                self.defocus_dy = dy
-        
-    
-        dxmat = np.array(dxmat)
-        dymat = np.array(dymat)
+        basis = ZernikeBasis(refx,refy)
+        hmat = basis.get(self.N,kind='h')
+        dxmat = basis.get(self.N,kind='dx')
+        dymat = basis.get(self.N,kind='dy')
         if self.regularize:
             A = np.vstack((dxmat.T,dymat.T,np.ones(self.N)))
         else:
@@ -379,22 +688,35 @@ class Reconstructor:
         #why did I originally write it this way?
         #self.matrix = np.dot(np.linalg.pinv(np.dot(A.T,A)),A.T)
         
-        self.zernike_matrix = np.linalg.pinv(A)
-        self.wavefront_matrix = np.array(hmat).T
-        self.wavefront = np.zeros(self.mask.shape)
-        
-    def get_wavefront(self,xslopes,yslopes):
-        if self.regularize:
-            newSlopeRow = np.zeros([1])
-            slopes = np.hstack((xslopes,yslopes,newSlopeRow))
-        else:
-            slopes = np.hstack((xslopes,yslopes))
-
-        coefs = np.dot(self.zernike_matrix,slopes)
-        wavefront_vec = np.dot(self.wavefront_matrix,coefs)*(self.pupil_size/2.0)
-        error = wavefront_vec.std()
-        self.wavefront[np.where(self.mask)] = wavefront_vec
-        return coefs,self.wavefront,error
+        arrays = {'zernike_matrix':np.linalg.pinv(A),
+                  'wavefront_matrix':hmat.T}
+        if self.N>4:
+            arrays['defocus_h'] = hmat[4]
+            arrays['defocus_dx'] = dxmat[4]
+            arrays['defocus_dy'] = dymat[4]
+        return arrays
+
+class WavefrontMaps:
+
+    def __init__(self,reconstructor,coefs):
+        """A lazily evaluated sequence of wavefront maps, one per row of
+        coefs, returned by Reconstructor.get_wavefronts. Indexing with an
+        integer returns one map; indexing with a slice or an index array
+        returns an (n,sy,sx) stack of maps. Maps are computed when they
+        are requested, and are not stored."""
+        self.reconstructor = reconstructor
+        self.coefs = coefs
+
+    def __len__(self):
+        return len(self.coefs)
+
+    def __getitem__(self,index):
+        r = self.reconstructor
+        coefs = self.coefs[index]
+        wavefronts = np.dot(coefs,r.scaled_wavefront_matrix.T)
+        maps = np.zeros(coefs.shape[:-1]+(r.mask.size,))
+        maps[...,r.mask_index] = wavefronts
+        return maps.reshape(coefs.shape[:-1]+r.mask.shape)
 
 
 if __name__=='__main__':
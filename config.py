@@ -33,7 +33,63 @@ dm_directory = ciao_root + '/etc/dm/'
 poke_directory = ciao_root + '/etc/ctrl/'
 logging_directory = ciao_root + '/log'
 simulator_cache_directory = '.simulator_cache'
+# reconstructor matrices are cached here, keyed by the reference geometry;
+# the least recently used entries are removed when there are more than
+# reconstructor_cache_max_entries
+reconstructor_cache_directory = '.reconstructor_cache'
+reconstructor_cache_max_entries = 8
+reconstructor_use_cache = True
 simulated_camera_image_directory = ciao_root + '/data/spots/'
+# consolidate the simulated camera's images into one memory-mapped stack,
+# cached in simulator_cache_directory
+simulated_camera_use_cache = True
+# occluders applied by the simulated camera when opacity is on (see
+# components/opacity.py); each entry gives the keyword arguments of an
+# Occluder: radius_px, transmission, drift_px, vx_px, vy_px, and, for
+# intermittent occluders such as blinks, period_frames and duration_frames
+simulated_camera_occluders = [{'radius_px':50,'transmission':0.2,'drift_px':0.5}]
+
+# the camera created by cameras.get_camera: 'pylon', 'simulated',
+# 'synthetic' or 'replay' (see components/cameras.py); if
+# camera_use_acquisition, it is wrapped in an Acquisition
+camera_backend = 'pylon'
+camera_use_acquisition = False
+# exposure time in microseconds set when the camera is opened; None leaves
+# the camera's setting
+camera_exposure_us = None
+# ReplayCamera replays the first replay_camera_n_frames (None for all)
+# images from simulated_camera_image_directory, memory-mapped from the
+# simulator's frame stack (see simulator_cache_directory), at
+# replay_camera_frame_rate frames per second (0 for as fast as they are
+# requested)
+replay_camera_n_frames = None
+replay_camera_frame_rate = 0.0
+
+# Acquisition (components/acquisition.py) grabs frames on its own thread:
+# up to camera_queue_size frames wait for the sensor, after which the
+# oldest are dropped; the Pylon driver grabs into camera_grab_buffers
+# buffers
+camera_queue_size = 2
+camera_grab_buffers = 8
+# pixel format set on the Pylon camera when opened, e.g. 'Mono8' or
+# 'Mono12'; None leaves the camera's setting. Images are returned in the
+# camera's native dtype (uint8 or uint16), without conversion.
+camera_pixel_format = None
+
+# synthetic spots images rendered by SyntheticCamera (see
+# components/simulator.py): spot peak and background levels in ADU, read
+# noise standard deviation in ADU (0 for none), drawn from a bank of
+# simulator_n_noise_frames precomputed frames; mirror surface deflection
+# per unit command, and width of the Gaussian actuator influence
+# functions, in actuator pitches; and the injected aberration, as Zernike
+# coefficients in meters, keyed by index j (e.g. {4:0.5e-6} for defocus)
+simulator_spot_amplitude = 2000.0
+simulator_background = 100.0
+simulator_read_noise = 0.0
+simulator_n_noise_frames = 4
+simulator_mirror_stroke_m = 1e-6
+simulator_influence_width = 0.7
+simulator_aberration_m = {}
 
 
 # The reference coordinates need a starting point (see README.md), and these
@@ -62,11 +118,44 @@ spots_threshold = 100.0
 sensor_update_rate = 20.0
 sensor_filter_lenslets = False
 sensor_reconstruct_wavefront = True
+# if False, the sensor computes the Zernike coefficients and RMS error but
+# not the wavefront map, e.g. for headless closed-loop runs
+sensor_wavefront_map = True
+# 'modal' (least squares fit of n_zernike_terms Zernike terms) or 'zonal'
+# (sparse Southwell reconstruction of the phase at every lenslet; see
+# components/reconstructors.py); with 'zonal', Zernike coefficients are
+# computed by projecting the phase map only if zonal_project_zernikes
+reconstructor_type = 'modal'
+zonal_project_zernikes = True
+# number of frames reconstructed at a time by Reconstructor.get_wavefronts
+reconstruction_chunk_size = 4096
 sensor_remove_tip_tilt = True
+# if True, the background-subtracted search boxes are written into a
+# separate image in each frame (SensorFrame.processed_image), which the
+# UI displays; the camera's image is never modified
+sensor_processed_image = False
+# if True, the camera reads out only the bounding box of the search
+# boxes, grown by sensor_roi_margin_px on every side (see Sensor.set_roi)
+sensor_roi = False
+sensor_roi_margin_px = 20
 centroiding_num_threads = 1
+# 'cython', 'numpy', or 'auto' (cython if it has been built, else numpy)
+centroiding_backend = 'auto'
 iterative_centroiding_step = 2
 centroiding_iterations = 1
 
+# telemetry logging: number of frames held in memory, and number of
+# frames accumulated before they are written to disk
+telemetry_buffer_size = 1024
+telemetry_chunk_size = 64
+
+# raw spots image capture: keep every Nth frame, in a stack of at most
+# capture_max_frames frames, with capture_queue_size frames buffered in
+# memory
+capture_every_n = 10
+capture_max_frames = 200
+capture_queue_size = 8
+
 mirror_update_rate = 200.0
 mirror_n_actuators = 97
 mirror_flat_filename = ciao_root + '/etc/dm/flat.txt'
@@ -75,11 +164,47 @@ mirror_command_max = 1.0
 mirror_command_min = -1.0
 mirror_settling_time_s = 0.001
 
-poke_command_max = 0.3
-poke_command_min = -0.3
-poke_n_command_steps = 5
+# headless pipeline (see components/pipeline.py): how often the control
+# stage copies its frame and command for display, and how many commands
+# the per-stage latency statistics cover
+pipeline_snapshot_interval_s = 0.05
+pipeline_latency_buffer_size = 100
+
+# The poke matrix is measured by poking all actuators at once, in
+# patterns of signs: 'hadamard' (the smallest Hadamard set with more
+# patterns than actuators), 'random' (poke_n_patterns random patterns),
+# or 'single' (one actuator at a time, by poke_amplitude). The spots move
+# by the sum of every actuator's response, so in the multi-actuator
+# patterns each actuator is poked by the smaller poke_pattern_amplitude.
+# Commands are clipped to mirror_command_min and mirror_command_max. With
+# poke_push_pull, each pattern is pushed and pulled (two frames per
+# pattern); otherwise the flat is measured once and each pattern only
+# pushed (one frame per pattern). Each pattern is measured poke_n_repeats
+# times; the UI is updated every poke_ui_update_interval patterns.
+poke_pattern = 'hadamard'
+poke_amplitude = 0.3
+poke_pattern_amplitude = 0.1
+poke_push_pull = True
+poke_n_patterns = 97
+poke_n_repeats = 1
+poke_ui_update_interval = 8
+
+# control matrices for recently seen lenslet masks are cached, up to
+# this total size
+ctrl_cache_max_mb = 64.0
+
+# how the poke matrix is decomposed to compute the control matrix:
+# 'gram' (eigendecomposition of poke.T poke; fastest, but only resolves
+# singular values down to about 1e-8 of the largest), 'svd' (thin SVD of
+# the poke matrix), or 'randomized' (randomized SVD of only the first
+# loop_n_control_modes modes, plus poke_randomized_oversampling)
+poke_inversion_method = 'gram'
+poke_randomized_oversampling = 10
+poke_randomized_power_iterations = 2
 
-ctrl_dictionary_max_size = 10
+# if nonzero, the inverted modes are damped by replacing 1/s with
+# s/(s**2+lambda**2), where s are the singular values of the poke matrix
+poke_tikhonov_lambda = 0.0
 
 loop_n_control_modes = 50
 loop_gain = 0.3
@@ -1,7 +1,7 @@
 import ciao
 from matplotlib import pyplot as plt
 
-cam = ciao.cameras.PylonCamera()
+cam = ciao.cameras.get_camera('pylon')
 sensor = ciao.sensors.Sensor(cam)
 
 sensor.sense()
@@ -2,7 +2,7 @@ import ciao
 from matplotlib import pyplot as plt
 import numpy as np
 
-cam = ciao.cameras.SimulatedCamera()
+cam = ciao.cameras.get_camera('simulated')
 sensor = ciao.sensors.Sensor(cam)
 
 sensor.sense()
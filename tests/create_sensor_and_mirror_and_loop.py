@@ -4,12 +4,15 @@ import numpy as np
 import sys
 from PyQt5.QtWidgets import QApplication
 
-#cam = ciao.cameras.SimulatedCamera()
-cam = ciao.cameras.PylonCamera()
+# the camera is chosen by ccfg.camera_backend
+cam = ciao.cameras.get_camera()
 sensor = ciao.sensors.Sensor(cam)
 
 sb = sensor.search_boxes
 mirror = ciao.mirrors.Mirror()
+# a SyntheticCamera renders spots from the mirror's command
+if hasattr(cam,'set_mirror'):
+    cam.set_mirror(mirror)
 
 app = QApplication(sys.argv)
 loop = ciao.loops.Loop(sensor,mirror)